@@ -0,0 +1,311 @@
+# coding: utf8
+
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from bench_utils import commit, run_spawned, save_results
+from constants import *
+from csv_cleaner import CSVCleaner
+
+
+# number of columns of fr.openfoodfacts.org.products.csv
+OFF_COLUMNS = 173
+
+# multipliers of the sizes passed on the command line, eg. 500M, 2G
+SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+# #####--- FUNCTIONS ----##### #
+def parse_size(size):
+    """
+    Returns a number of bytes from a size like 100M or 2G.
+    """
+    unit = SIZE_UNITS.get(size[-1].upper())
+    if unit is None:
+        return int(size)
+    return int(float(size[:-1]) * unit)
+
+
+def off_columns(columns, seed=0):
+    """
+    Returns the columns of a synthetic Open Food Facts csv: the
+    HEADERS_LIST ones, spread among fillers, code being the first one.
+    """
+    rng = np.random.RandomState(seed)
+    fillers = [
+        "filler_{}".format(i) for i in range(columns - len(HEADERS_LIST))
+    ]
+    others = HEADERS_LIST[1:] + fillers
+    return ["code"] + [others[i] for i in rng.permutation(len(others))]
+
+
+def off_rows(rng, start, rows, columns):
+    """
+    Returns a dataframe of rows synthetic Open Food Facts products, coded
+    from start. As in the real file, most products are not kept by the
+    cleaning (other categories or countries, no name or grade), and most
+    of the other columns are empty.
+    """
+    codes = np.arange(start, start + rows)
+    images = "https://static.openfoodfacts.org/images/products/{}/front"
+    categories = np.array(
+        CATEGORIES_LIST + ["Category {}".format(i) for i in range(500)],
+        dtype=object,
+    )
+
+    def sometimes(values, ratio):
+        # values, replaced by missing values in 1 - ratio of the rows
+        return np.where(rng.rand(rows) < ratio, values, None)
+
+    df = pd.DataFrame({
+        "code": codes,
+        "url": [
+            "http://world-fr.openfoodfacts.org/produit/{0}/product-{0}".format(
+                code
+            )
+            for code in codes
+        ],
+        "product_name": sometimes(
+            ["Product {}".format(code) for code in codes], 0.9
+        ),
+        "brands": sometimes(
+            ["Brand {}".format(rank) for rank in rng.zipf(1.3, rows) % 50000],
+            0.8,
+        ),
+        "stores": sometimes(
+            ["Store {}".format(rank) for rank in rng.zipf(1.3, rows) % 500],
+            0.4,
+        ),
+        "nutrition_grade_fr": sometimes(
+            rng.choice(list("abcdeABCDE"), rows), 0.6
+        ),
+        "main_category_fr": sometimes(
+            categories[(rng.zipf(1.2, rows) - 1) % len(categories)], 0.5
+        ),
+        "countries_fr": rng.choice(
+            ["France", "France", "France", "Espagne", "Belgique", "Suisse"],
+            rows,
+        ),
+        "energy_100g": sometimes(rng.uniform(0, 2500, rows).round(), 0.7),
+        "fat_100g": sometimes(rng.uniform(0, 60, rows).round(1), 0.7),
+        "carbohydrates_100g": sometimes(
+            rng.uniform(0, 90, rows).round(1), 0.7
+        ),
+        "sugars_100g": sometimes(rng.uniform(0, 60, rows).round(1), 0.7),
+        "fiber_100g": sometimes(rng.uniform(0, 15, rows).round(1), 0.5),
+        "proteins_100g": sometimes(rng.uniform(0, 30, rows).round(1), 0.7),
+        "salt_100g": sometimes(rng.uniform(0, 3, rows).round(2), 0.7),
+        "image_url": sometimes(
+            [(images + ".jpg").format(code) for code in codes], 0.6
+        ),
+        "image_small_url": sometimes(
+            [(images + ".200.jpg").format(code) for code in codes], 0.6
+        ),
+        "last_modified_t": rng.randint(1400000000, 1530000000, rows),
+    })
+
+    # a few kinds of filler columns, shared by all the fillers
+    fillers = [
+        sometimes("en:some-tag,en:other-tag", 0.3),
+        sometimes(rng.randint(0, 100000, rows), 0.2),
+        sometimes("1,234", 0.1),
+        sometimes("x", 0.05),
+        np.full(rows, None),
+    ]
+    for i, col in enumerate(columns):
+        if col not in df:
+            df[col] = fillers[i % len(fillers)]
+
+    return df[columns]
+
+
+def generate_file(fname, size, columns, block_rows=10000, seed=0):
+    """
+    Writes a tab separated csv of synthetic Open Food Facts products of
+    (at least) size bytes, block_rows products at a time.
+    Returns its number of products.
+    """
+    rng = np.random.RandomState(seed)
+    columns = off_columns(columns, seed)
+
+    rows = 0
+    with open(fname, "w", encoding="utf-8") as f:
+        while f.tell() < size:
+            off_rows(rng, rows, block_rows, columns).to_csv(
+                f, sep="\t", index=False, header=(rows == 0)
+            )
+            rows += block_rows
+
+    return rows
+
+
+def dataset(data_dir, size, columns):
+    """
+    Returns the file name and the number of products of the synthetic csv
+    of size bytes, generated the first time it is needed: big files are
+    long to generate.
+    """
+    fname = os.path.join(
+        data_dir, "off_{}_{}.csv".format(size, columns)
+    )
+    meta_fname = fname + ".json"
+
+    if not os.path.exists(meta_fname):
+        print("Generating {}...".format(fname))
+        rows = generate_file(fname, size, columns)
+        with open(meta_fname, "w") as f:
+            json.dump({"rows": rows}, f)
+
+    with open(meta_fname) as f:
+        return fname, json.load(f)["rows"]
+
+
+def output_size(path):
+    """
+    Returns the size in bytes of a file, or of all the files of a directory.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, dirs, names in os.walk(path)
+        for name in names
+    )
+
+
+def bench(fname, rows, options, trace, result_fname):
+    """
+    Cleans a synthetic csv in a temporary directory, and writes the
+    measures of the cleaning to result_fname.
+    Run in a process of its own, so that the peak RSS is the one of this
+    cleaning only. Peak RSS of the workers is the one of the biggest.
+    options: passed to CSVCleaner.csv_cleaner
+    trace: also measures the peak of the memory allocated by python with
+    tracemalloc, which slows the cleaning down
+    """
+    if trace:
+        tracemalloc.start()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # the cleaned csv, its cache and the state are written to tmp_dir
+        os.chdir(tmp_dir)
+
+        start = time.perf_counter()
+        CSVCleaner(fname).csv_cleaner(
+            HEADERS_LIST, CATEGORIES_LIST, COUNTRIES_LIST, **options
+        )
+        elapsed = time.perf_counter() - start
+
+        result = dict(
+            options,
+            input_size=os.path.getsize(fname),
+            rows=rows,
+            elapsed=round(elapsed, 3),
+            rows_per_s=round(rows / elapsed),
+            output_size=output_size(CLEANED_CSV_FILE),
+            cache_size=output_size("db_file_cache"),
+            # kilobytes on linux
+            peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            peak_rss_workers=resource.getrusage(
+                resource.RUSAGE_CHILDREN
+            ).ru_maxrss,
+            peak_traced=tracemalloc.get_traced_memory()[1] if trace else None,
+        )
+
+    with open(result_fname, "w") as f:
+        json.dump(result, f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks csv_cleaner.py on synthetic csv files"
+    )
+    parser.add_argument(
+        "-s", "--sizes",
+        nargs="+",
+        default=["100M", "1G", "4G"],
+        help="sizes of the csv files, eg. 100M 2G",
+    )
+    parser.add_argument(
+        "-c", "--chunk-sizes",
+        type=int,
+        nargs="*",
+        default=[10000, CHUNK_SIZE, 1000000],
+        help="chunk sizes of the streaming mode",
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        nargs="*",
+        default=sorted({1, 2, os.cpu_count()}),
+        help="numbers of workers of the parallel mode",
+    )
+    parser.add_argument(
+        "--whole",
+        action="store_true",
+        help="also cleans the files at once, needs memory for the whole file",
+    )
+    parser.add_argument(
+        "--columns",
+        type=int,
+        default=OFF_COLUMNS,
+        help="number of columns of the csv files",
+    )
+    parser.add_argument(
+        "-t", "--tracemalloc",
+        action="store_true",
+        help="also measures the memory allocated by python",
+    )
+    parser.add_argument(
+        "-d", "--data-dir",
+        default="bench_data",
+        help="directory of the generated csv files, kept between runs",
+    )
+    parser.add_argument(
+        "-o", "--output",
+        default="bench_cleaner.json",
+        help="json file the results are written to",
+    )
+    args = parser.parse_args()
+
+    modes = [{"chunksize": size} for size in args.chunk_sizes]
+    modes += [{"workers": workers} for workers in args.workers]
+    if args.whole:
+        modes.append({})
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    output = os.path.abspath(args.output)
+    result_fname = output + ".run"
+
+    results = {"commit": commit(), "columns": args.columns, "runs": []}
+
+    for size in args.sizes:
+        fname, rows = dataset(
+            os.path.abspath(args.data_dir), parse_size(size), args.columns
+        )
+
+        for options in modes:
+            print("Cleaning {} with {}...".format(fname, options))
+
+            run_spawned(
+                bench,
+                (fname, rows, options, args.tracemalloc, result_fname),
+                "cleaning of {} with {} failed".format(fname, options),
+            )
+
+            with open(result_fname) as f:
+                results["runs"].append(json.load(f))
+            os.remove(result_fname)
+
+            save_results(output, results)
+
+    print("Results written to {}".format(output))
@@ -0,0 +1,186 @@
+# coding: utf8
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+# sets django up, the benchmark feeds the database of the settings
+import db_feeding
+from django.db import connection, connections
+from bench_utils import commit, run_spawned, save_results
+from constants import *
+from dataset import apply_schema, write_cache
+
+
+# #####--- FUNCTIONS ----##### #
+def zipf_names(rng, prefix, cardinality, size):
+    """
+    Returns size names among cardinality ones (prefix followed by a
+    number), a few of them being much more frequent than the others,
+    as brands and stores are in the Open Food Facts data.
+    """
+    ranks = (rng.zipf(1.3, size) - 1) % cardinality
+    return pd.Series(ranks).map(lambda rank: "{} {}".format(prefix, rank))
+
+
+def synthetic_dataset(rows, seed=0):
+    """
+    Returns a dataframe of rows products shaped like the cleaned csv
+    (HEADERS_LIST columns, typed with HEADERS_DTYPES).
+    Cardinalities are those of the french catalog: up to one brand for
+    seven products, a few hundred stores and categories, one to three
+    brands and up to three stores per product.
+    """
+    rng = np.random.RandomState(seed)
+    codes = np.arange(rows) + 3000000000000
+
+    def names(prefix, cardinality, counts):
+        # comma separated lists of counts names, empty when counts is 0
+        lists = pd.Series("", index=range(rows))
+        for i in range(counts.max()):
+            name = zipf_names(rng, prefix, cardinality, rows)
+            lists = lists.where(counts <= i, lists + ("," if i else "") + name)
+        return lists.replace("", np.nan)
+
+    brands = names(
+        "Brand", max(rows // 7, 1), rng.choice([1, 1, 1, 1, 2, 3], rows)
+    )
+    stores = names(
+        "Store", min(max(rows // 30, 1), 500),
+        rng.choice([0, 0, 1, 2, 3], rows),
+    )
+
+    urls = pd.Series(codes).map(
+        "https://fr.openfoodfacts.org/produit/{}".format
+    )
+    images = "https://static.openfoodfacts.org/images/products/{}/front"
+
+    df = pd.DataFrame({
+        "code": codes,
+        "url": urls,
+        "product_name": pd.Series(codes).map("Product {}".format),
+        "brands": brands,
+        "stores": stores,
+        "nutrition_grade_fr": rng.choice(list("abcde"), rows),
+        "main_category_fr": zipf_names(
+            rng, "Category", min(max(rows // 100, 1), 400), rows
+        ),
+        "countries_fr": "France",
+        "energy_100g": rng.uniform(0, 2500, rows).round(),
+        "fat_100g": rng.uniform(0, 60, rows).round(1),
+        "carbohydrates_100g": rng.uniform(0, 90, rows).round(1),
+        "sugars_100g": rng.uniform(0, 60, rows).round(1),
+        "fiber_100g": rng.uniform(0, 15, rows).round(1),
+        "proteins_100g": rng.uniform(0, 30, rows).round(1),
+        "salt_100g": rng.uniform(0, 3, rows).round(2),
+        "image_url": pd.Series(codes).map((images + ".jpg").format),
+        "image_small_url": pd.Series(codes).map((images + ".200.jpg").format),
+        "last_modified_t": rng.randint(1400000000, 1530000000, rows),
+    }, columns=HEADERS_LIST)
+
+    return apply_schema(df)
+
+
+def write_dataset(df, fname):
+    """
+    Saves a synthetic dataset as the cleaner does: csv file, then its
+    columnar cache.
+    """
+    df.to_csv(fname, index=False, encoding="utf-8", sep=";")
+    write_cache(df, fname)
+
+
+def bench(data_dir, options):
+    """
+    Feeds the dataset of data_dir to a throwaway database, and saves the
+    summary of the feeding to data_dir (see db_feeding.write_stats).
+    Run in a process of its own, so that the peak RSS of its stages is
+    the one of this feeding only.
+    options: passed to db_feeding.main
+    """
+    # the test database of the settings, created with its migrations
+    old_name = connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, serialize=False
+    )
+
+    try:
+        os.chdir(data_dir)
+        db_feeding.main(**options)
+    finally:
+        connections.close_all()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks db_feeding.py on synthetic datasets"
+    )
+    parser.add_argument(
+        "-r", "--rows",
+        type=int,
+        nargs="+",
+        default=[10000, 100000, 1000000],
+        help="sizes of the datasets, in products",
+    )
+    parser.add_argument(
+        "-o", "--output",
+        default="bench_feeding.json",
+        help="json file the results are written to",
+    )
+    parser.add_argument(
+        "-b", "--batch-size",
+        type=int,
+        default=FEED_BATCH_SIZE,
+        help="see db_feeding.py",
+    )
+    parser.add_argument(
+        "-c", "--copy",
+        action="store_true",
+        help="see db_feeding.py",
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        help="see db_feeding.py",
+    )
+    args = parser.parse_args()
+
+    options = {
+        "batch_size": args.batch_size,
+        "copy": args.copy,
+        "workers": args.workers,
+    }
+    results = {"commit": commit(), "options": options, "runs": []}
+    output = os.path.abspath(args.output)
+
+    for rows in args.rows:
+        print("Benchmarking {} rows...".format(rows))
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            start = time.perf_counter()
+            write_dataset(
+                synthetic_dataset(rows),
+                os.path.join(data_dir, CLEANED_CSV_FILE),
+            )
+            generated = time.perf_counter() - start
+
+            run_spawned(
+                bench, (data_dir, options),
+                "benchmark of {} rows failed".format(rows),
+            )
+
+            with open(os.path.join(data_dir, FEED_STATS_FILE)) as f:
+                summary = json.load(f)
+
+        summary["rows"] = rows
+        summary["generated"] = round(generated, 3)
+        results["runs"].append(summary)
+
+        save_results(output, results)
+
+    print("Results written to {}".format(output))
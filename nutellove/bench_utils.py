@@ -0,0 +1,48 @@
+# coding: utf8
+
+import json
+import multiprocessing
+import subprocess
+
+# Helpers shared by the benchmarks (bench_cleaner.py, bench_feeding.py),
+# which must not set django up.
+
+
+# #####--- FUNCTIONS ----##### #
+def commit():
+    """
+    Returns the git commit the benchmark runs on, None out of git.
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_spawned(target, args, error):
+    """
+    Runs target(*args) in a process of its own, raises RuntimeError(error)
+    if it fails.
+    Spawned, not forked: the process does not start with the memory of
+    this one, which generated the data. Not a pool process either, which
+    could not start workers.
+    """
+    process = multiprocessing.get_context("spawn").Process(
+        target=target, args=args
+    )
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(error)
+
+
+def save_results(output, results):
+    """
+    Writes the results of the runs done so far to the json file output,
+    after each run, in case a bigger one fails.
+    """
+    with open(output, "w") as f:
+        json.dump(results, f, indent=4)
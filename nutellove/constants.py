@@ -5,6 +5,28 @@ CSV_URL = "https://world.openfoodfacts.org/data/fr.openfoodfacts.org.products.cs
 CSV_FNAME = 'fr.openfoodfacts.org.products.csv'
 CLEANED_CSV_FILE = "db_file.csv"
 
+# number of rows read at once when cleaning the csv in streaming mode
+CHUNK_SIZE = 100000
+
+# size in bytes of the pieces of the csv cleaned by each worker process
+PIECE_SIZE = 64 * 1024 * 1024
+
+# last_modified_t high-water mark and codes seen by the previous cleanings,
+# used to only keep new or modified products in incremental mode
+CLEANER_STATE_FILE = "cleaner_state.json"
+
+# number of rows resolved and inserted at once when feeding the database
+FEED_BATCH_SIZE = 1000
+
+# rows, throughput and queries of each stage of the last feeding
+FEED_STATS_FILE = "feed_stats.json"
+
+# number of substitutes of a product computed when feeding the database
+SUBSTITUTES_COUNT = 30
+
+# number of products of the pool of suggestions drawn when feeding
+SUGGESTIONS_COUNT = 1000
+
 # config files constants
 CFG_FNAME = "postgresql_config.ini"
 
@@ -29,6 +51,30 @@ HEADERS_LIST = [
     "last_modified_t",
 ]
 
+# dtypes of the HEADERS_LIST columns, used to read the csv files:
+# columns with few distinct values are categoricals, nutrients are float32.
+# Rows whose int64 values are missing or invalid are dropped.
+HEADERS_DTYPES = {
+    "code": "int64",
+    "url": "object",
+    "product_name": "object",
+    "brands": "object",
+    "stores": "object",
+    "nutrition_grade_fr": "category",
+    "main_category_fr": "category",
+    "countries_fr": "category",
+    "energy_100g": "float32",
+    "fat_100g": "float32",
+    "carbohydrates_100g": "float32",
+    "sugars_100g": "float32",
+    "fiber_100g": "float32",
+    "proteins_100g": "float32",
+    "salt_100g": "float32",
+    "image_url": "object",
+    "image_small_url": "object",
+    "last_modified_t": "int64",
+}
+
 CATEGORIES_LIST = [
     # 'Petit-déjeuners',
     'Chips et frites',
@@ -1,43 +1,114 @@
 # coding: utf8
 
+import argparse
+import io
+import json
+import multiprocessing
+import os
+
 import pandas as pd
 
 from constants import *
+from dataset import CacheWriter, apply_schema, file_signature, read_dtypes
+
+
+# #####--- FUNCTIONS ----##### #
+def split_file(fname, piece_size):
+    """
+    Splits a csv file in pieces of about piece_size bytes.
+    Returns the list of the columns of the file and a list of
+    (start, end) offsets, each piece starting and ending on a line boundary.
+    The header line is not part of any piece.
+    """
+    size = os.path.getsize(fname)
+
+    with open(fname, "rb") as f:
+        columns = f.readline().decode("utf-8").rstrip("\r\n").split("\t")
+        start = f.tell()
+
+        bounds = [start]
+        for offset in range(start + piece_size, size, piece_size):
+            # moves to the end of the line the offset falls into
+            f.seek(offset)
+            f.readline()
+            if f.tell() > bounds[-1]:
+                bounds.append(f.tell())
+
+    if bounds[-1] < size:
+        bounds.append(size)
+
+    return columns, list(zip(bounds, bounds[1:]))
+
+
+def clean_piece(job):
+    """
+    Cleans a piece of a csv file, in a worker process.
+    job: a tuple (fname, start, end, columns, headers, categories, countries)
+    Returns the filtered dataframe.
+    """
+    fname, start, end, columns, headers, categories, countries = job
+
+    with open(fname, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
 
+    # names: the header line is only in the first piece of the file
+    df = pd.read_csv(
+        io.BytesIO(data),
+        sep="\t",
+        encoding="utf-8",
+        header=None,
+        names=columns,
+        usecols=headers,
+        dtype=read_dtypes(),
+        thousands=',',
+    )
 
+    return CSVCleaner(fname).filter_df(df[headers], categories, countries)
+
+
+def pending_state_file(state_file):
+    """
+    Returns the file of the state of a cleaning not fed yet.
+    """
+    return state_file + ".pending"
+
+
+def commit_state(fname, state_file=CLEANER_STATE_FILE):
+    """
+    Makes the state of the cleaning which wrote the csv file fname the one
+    of the next cleanings, once fname is fed (see db_feeding.main).
+    Does nothing if the pending state is of another version of fname.
+    """
+    pending_file = pending_state_file(state_file)
+
+    try:
+        with open(pending_file) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return
+
+    if state["source"] == file_signature(fname):
+        os.replace(pending_file, state_file)
+
+
+# #####--- CLASSES ----##### #
 class CSVCleaner():
 
-    def __init__(self, file_name):
+    def __init__(self, file_name, state_file=CLEANER_STATE_FILE):
         # disable SettingWithCopyWarning
         pd.options.mode.chained_assignment = None  # default='warn'
         self.file_name = file_name
+        self.state_file = state_file
 
-    def csv_cleaner(self, headers, categories=[], countries=[]):
+    def filter_df(self, df, categories=[], countries=[]):
         """
-        Cleans the csv passed to the instanciation of the class.
-        headers: a list of headers that must be in the file.
+        Returns the rows of a dataframe that must be kept in the cleaned csv.
+        df: a dataframe containing (at least) the headers columns.
         Optionals:
         categories: a list of categories to keep in the csv
         countries: a list of countries to filter the csv
         """
-        fname = self.file_name
-
-        print("Cleaning CSV file... Please wait...")
-
-        # reads the specified file.
-        # sep: csv file's separator
-        # low_memory: avoiding unnecessary warning msgs
-        csv_file = pd.read_csv(
-            fname,
-            sep="\t",
-            encoding="utf-8",
-            low_memory=False,
-            thousands=',',
-        )
-
-        # defines a dataframe, from the passed headers
-        df = csv_file[headers]
-
         # structures the new file to create
         # selects only specified parameters (eg. categories, countries)
         # drops products that have no name.
@@ -51,17 +122,214 @@ class CSVCleaner():
         # set nutri_grade to lower case, just in case
         new_f['nutrition_grade_fr'] = new_f['nutrition_grade_fr'].str.lower()
 
-        # save the new file to a csv file, with the name "db_file.csv"
-        new_f.to_csv(
-            "db_file.csv",
+        return apply_schema(new_f)
+
+    def load_state(self):
+        """
+        Loads the state saved by the previous cleaning:
+        the high-water mark of last_modified_t and the codes already seen.
+        """
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {"last_modified_t": None, "codes": []}
+
+        self.last_modified_t = state["last_modified_t"]
+        # an index hashes its values once, for every lookup of the run
+        self.seen_codes = pd.Index(state["codes"], dtype="int64")
+
+        # state of the current run, saved once it is over
+        self.new_last_modified_t = self.last_modified_t
+        self.new_codes = set()
+
+    def save_state(self):
+        """
+        Saves the high-water mark of last_modified_t and the codes
+        seen by this cleaning and the previous ones, as a pending state:
+        the next cleanings only read it once the cleaned csv is fed (see
+        commit_state).
+        """
+        state = {
+            "last_modified_t": self.new_last_modified_t,
+            "codes": self.seen_codes.union(
+                pd.Index(list(self.new_codes), dtype="int64")
+            ).tolist(),
+            # the version of the cleaned csv the state is the one of
+            "source": file_signature(CLEANED_CSV_FILE),
+        }
+
+        # the state is replaced at once, never partially written
+        pending_file = pending_state_file(self.state_file)
+        tmp_file = pending_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_file, pending_file)
+
+    def select_delta(self, df, incremental=False):
+        """
+        Records the rows of a cleaned dataframe in the state of the run.
+        incremental: only returns the rows whose code was never seen, or
+        modified after the high-water mark of the previous cleaning.
+        """
+        codes = df["code"]
+
+        self.new_codes.update(codes.tolist())
+        if len(df):
+            last_modified_t = int(df["last_modified_t"].max())
+            if (
+                self.new_last_modified_t is None or
+                last_modified_t > self.new_last_modified_t
+            ):
+                self.new_last_modified_t = last_modified_t
+
+        if not incremental or self.last_modified_t is None:
+            return df
+
+        new = self.seen_codes.get_indexer(codes.values) == -1
+        modified = (df["last_modified_t"] > self.last_modified_t).values
+
+        return df.loc[new | modified]
+
+    def write_df(self, df, append=False):
+        """
+        Saves a cleaned dataframe to a csv file, with the name "db_file.csv".
+        append: appends the rows to the file instead of creating it.
+        """
+        df.to_csv(
+            CLEANED_CSV_FILE,
+            mode="a" if append else "w",
+            header=not append,
             index=False,
             encoding="utf-8",
             sep=";",
         )
 
+    def csv_cleaner(self, headers, categories=[], countries=[],
+                    chunksize=None, workers=None, piece_size=PIECE_SIZE,
+                    incremental=False):
+        """
+        Cleans the csv passed to the instanciation of the class.
+        headers: a list of headers that must be in the file.
+        Optionals:
+        categories: a list of categories to keep in the csv
+        countries: a list of countries to filter the csv
+        chunksize: streams the file by chunks of chunksize rows, reading
+        only the headers columns. Memory used then depends on chunksize,
+        not on the size of the file.
+        workers: number of processes cleaning the file in parallel, by
+        pieces of piece_size bytes. Pieces are written in the order of the
+        file, whatever the order they are cleaned in.
+        incremental: only keeps the products that are new or modified since
+        the previous cleaning, so that db_feeding.py only feeds the delta.
+        Every cleaning saves the last_modified_t high-water mark and the
+        codes it has seen, committed to state_file once db_feeding.py fed
+        the cleaned csv.
+        Also writes a columnar cache of the cleaned csv (see dataset.py),
+        loaded by db_feeding.py instead of parsing the csv, as the cleaned
+        parts are written.
+        """
+        fname = self.file_name
+
+        print("Cleaning CSV file... Please wait...")
+
+        cache = CacheWriter(CLEANED_CSV_FILE, headers)
+
+        self.load_state()
+
+        if workers is not None:
+            columns, pieces = split_file(fname, piece_size)
+            jobs = [
+                (fname, start, end, columns, headers, categories, countries)
+                for start, end in pieces
+            ]
+
+            # writes the headers, even if the file has no rows
+            self.write_df(pd.DataFrame(columns=headers))
+
+            with multiprocessing.Pool(workers) as pool:
+                # imap returns the results in the order of the jobs
+                for new_f in pool.imap(clean_piece, jobs):
+                    new_f = self.select_delta(new_f, incremental)
+                    self.write_df(new_f, append=True)
+                    cache.append(new_f)
+
+        elif chunksize is not None:
+            # usecols: only parses the columns we need
+            # dtype: columns are read with their declared dtype, otherwise
+            # their type would depend on the content of each chunk
+            chunks = pd.read_csv(
+                fname,
+                sep="\t",
+                encoding="utf-8",
+                usecols=headers,
+                dtype=read_dtypes(),
+                thousands=',',
+                chunksize=chunksize,
+            )
+
+            for i, chunk in enumerate(chunks):
+                # usecols keeps the order of the file, not the headers one
+                new_f = self.filter_df(chunk[headers], categories, countries)
+                new_f = self.select_delta(new_f, incremental)
+
+                # the first chunk creates the file and writes the headers,
+                # the next ones are appended to it
+                self.write_df(new_f, append=(i > 0))
+                cache.append(new_f)
+
+        else:
+            # reads the specified file.
+            # sep: csv file's separator
+            # low_memory: avoiding unnecessary warning msgs
+            # dtype: HEADERS_LIST columns are read with their declared dtype
+            csv_file = pd.read_csv(
+                fname,
+                sep="\t",
+                encoding="utf-8",
+                low_memory=False,
+                dtype=read_dtypes(),
+                thousands=',',
+            )
+
+            # defines a dataframe, from the passed headers
+            df = csv_file[headers]
+
+            new_f = self.filter_df(df, categories, countries)
+            new_f = self.select_delta(new_f, incremental)
+
+            self.write_df(new_f)
+            cache.append(new_f)
+
+        # the first incremental cleaning keeps every row
+        cache.close(delta=incremental and self.last_modified_t is not None)
+
+        self.save_state()
+
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(
+        description="Cleans the Open Food Facts csv to db_file.csv"
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        nargs="?",
+        const=os.cpu_count(),
+        help="cleans the file in parallel (defaults to the number of cores)",
+    )
+    parser.add_argument(
+        "-i", "--incremental",
+        action="store_true",
+        help="only keeps products new or modified since the last cleaning",
+    )
+    args = parser.parse_args()
+
     new_csv = CSVCleaner("fr.openfoodfacts.org.products.csv")
 
-    new_csv.csv_cleaner(HEADERS_LIST, CATEGORIES_LIST, COUNTRIES_LIST)
+    new_csv.csv_cleaner(
+        HEADERS_LIST, CATEGORIES_LIST, COUNTRIES_LIST,
+        chunksize=CHUNK_SIZE, workers=args.workers,
+        incremental=args.incremental,
+    )
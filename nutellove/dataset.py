@@ -0,0 +1,433 @@
+# coding: utf8
+
+import itertools
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from constants import HEADERS_DTYPES
+
+
+# #####--- FUNCTIONS ----##### #
+def read_dtypes(dtypes=HEADERS_DTYPES):
+    """
+    Returns the dtypes to pass to pd.read_csv.
+    int64 columns are read as strings, as they may hold missing or
+    invalid values: they are converted by apply_schema.
+    """
+    return {
+        col: str if dtype == "int64" else dtype
+        for col, dtype in dtypes.items()
+    }
+
+
+def apply_schema(df, dtypes=HEADERS_DTYPES):
+    """
+    Converts the columns of a dataframe to their declared dtypes.
+    Rows whose int64 values are missing or invalid are dropped.
+    """
+    dtypes = {col: dtype for col, dtype in dtypes.items() if col in df}
+
+    ints = {}
+    valid = pd.Series(True, index=df.index)
+    for col, dtype in dtypes.items():
+        if dtype == "int64" and df[col].dtype != dtype:
+            ints[col] = pd.to_numeric(df[col], errors="coerce")
+            valid &= ints[col].notnull()
+
+    if ints:
+        df = df.assign(**ints).loc[valid]
+
+    return df.astype(dtypes)
+
+
+def df_to_records(df):
+    """
+    Returns the rows of a dataframe as a list of dicts of python values,
+    missing values being replaced by None.
+    Converted column by column, the dataframe is never copied as a whole.
+    """
+    columns = []
+    for col in df.columns:
+        series = df[col]
+
+        if series.dtype == np.float32:
+            # str() gives the shortest repr of a float32, so that
+            # 28.7 is not converted to 28.700000762939453
+            values = series.astype(str).astype(float).tolist()
+        else:
+            values = series.astype(object).tolist()
+
+        columns.append([
+            None if value is None or value != value else value
+            for value in values
+        ])
+
+    return [dict(zip(df.columns, row)) for row in zip(*columns)]
+
+
+def record_batches(df, batch_size, start=0):
+    """
+    Yields the rows of a dataframe from position start, as lists of
+    batch_size dicts (see df_to_records), or less for the last one.
+    Only one batch is converted at a time.
+    """
+    for position in range(start, len(df), batch_size):
+        yield df_to_records(df.iloc[position:position + batch_size])
+
+
+def cache_path(fname):
+    """
+    Returns the directory of the columnar cache of a cleaned csv file.
+    eg. db_file.csv -> db_file_cache
+    """
+    return os.path.splitext(os.path.abspath(fname))[0] + "_cache"
+
+
+def file_signature(fname):
+    """
+    Returns what identifies a version of a file: its size and modification
+    time. Returns None if the file does not exist.
+    """
+    try:
+        stat = os.stat(fname)
+    except FileNotFoundError:
+        return None
+
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def append_strings(path, strings, size):
+    """
+    Appends a list of strings to a string table: a blob of utf-8 bytes,
+    and the offset of the end of each string in the blob.
+    size: the size of the blob before the strings are appended.
+    Returns the size of the blob once they are.
+    """
+    encoded = [string.encode("utf-8") for string in strings]
+    ends = size + np.cumsum(
+        [len(string) for string in encoded], dtype=np.int64
+    )
+
+    with open(path + ".offsets.bin", "ab") as f:
+        ends.tofile(f)
+    with open(path + ".blob.bin", "ab") as f:
+        f.write(b"".join(encoded))
+
+    return int(ends[-1]) if len(ends) else size
+
+
+def read_strings(path):
+    """
+    Loads a string table written by append_strings, as an array of objects.
+    """
+    offsets = np.fromfile(path + ".offsets.bin", dtype=np.int64)
+    with open(path + ".blob.bin", "rb") as f:
+        blob = f.read()
+
+    strings = np.empty(len(offsets), dtype=object)
+    strings[:] = [
+        blob[start:end].decode("utf-8")
+        for start, end in zip(np.append(0, offsets[:-1]), offsets)
+    ]
+    return strings
+
+
+def write_cache(df, fname):
+    """
+    Saves a cleaned dataframe as the columnar cache of the csv file fname
+    (see CacheWriter). Must be called once fname is written.
+    """
+    writer = CacheWriter(fname, df.columns)
+    writer.append(df)
+    writer.close()
+
+
+def read_meta(fname):
+    """
+    Returns the description of the columnar cache of the csv file fname
+    (see CacheWriter.close). Returns None if the cache is missing, or stale
+    (fname changed since the cache was written).
+    """
+    try:
+        with open(os.path.join(cache_path(fname), "meta.json")) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    if meta["source"] != file_signature(fname):
+        return None
+
+    return meta
+
+
+def is_delta(fname):
+    """
+    Returns whether the cleaned csv file fname only holds the delta of an
+    incremental cleaning, as recorded in its cache. None if the cache is
+    missing or stale: what fname holds is unknown.
+    """
+    meta = read_meta(fname)
+    if meta is None:
+        return None
+
+    return meta.get("delta", False)
+
+
+def read_cache(fname):
+    """
+    Loads the columnar cache of the csv file fname as a dataframe.
+    Returns None if the cache is missing, or stale.
+    """
+    path = cache_path(fname)
+
+    meta = read_meta(fname)
+    if meta is None:
+        return None
+
+    data = {}
+    for i, column in enumerate(meta["columns"]):
+        col_path = os.path.join(path, str(i))
+
+        if column["kind"] == "numeric":
+            data[column["name"]] = np.fromfile(
+                col_path + ".bin", dtype=column["dtype"]
+            )
+            continue
+
+        codes = np.fromfile(col_path + ".codes.bin", dtype=np.int32)
+
+        if column["kind"] == "categorical":
+            data[column["name"]] = pd.Categorical.from_codes(
+                codes, read_strings(col_path)
+            )
+
+        else:
+            # the code -1 points to the appended missing value
+            strings = np.append(read_strings(col_path), np.nan)
+            data[column["name"]] = strings[codes]
+
+    return pd.DataFrame(
+        data, columns=[column["name"] for column in meta["columns"]]
+    )
+
+
+def read_dataset(fname):
+    """
+    Returns the cleaned dataset as a pandas dataframe, typed with
+    HEADERS_DTYPES. Loads it from its columnar cache if it is up to date,
+    parses the csv file otherwise.
+    """
+    df = read_cache(fname)
+
+    if df is None:
+        # reads the specified file.
+        # sep: csv file's separator
+        # dtype: no type inference, columns are read with their dtype
+        df = pd.read_csv(
+            fname,
+            sep=";",
+            encoding="utf-8",
+            dtype=read_dtypes(),
+        )
+        df = apply_schema(df)
+
+    return df
+
+
+def split_names(series):
+    """
+    Splits a column of comma separated names (brands or stores).
+    Returns a series of names, indexed by the index of their row.
+    Names are normalized here, for every stage of the feeding: stripped
+    and capitalized. Empty names are dropped.
+    """
+    names = series.dropna()
+    if names.empty:
+        return pd.Series([], dtype=object)
+
+    lists = names.str.split(",")
+
+    # one row per name, rather than a column per name of the longest list
+    names = pd.Series(
+        list(itertools.chain.from_iterable(lists)),
+        index=np.repeat(lists.index.values, lists.str.len().values),
+    )
+    names = names.str.strip().str.capitalize()
+
+    return names[names != ""]
+
+
+def row_categories(df):
+    """
+    Returns the category each row of a dataframe is fed with: the
+    main_category_fr of the first row of its url, so that all the rows of
+    a product belong to the same category.
+    """
+    first = df.drop_duplicates("url").set_index("url")["main_category_fr"]
+    return df["url"].map(first.astype(object))
+
+
+# #####--- CLASSES ----##### #
+class CacheWriter():
+    """
+    Writes the columnar cache of a cleaned csv file, one dataframe at a
+    time, so that the cleaner never holds the whole of it.
+    Numeric columns are saved as raw numpy arrays of their dtype. Other
+    columns are saved as integer codes (-1 for missing values) and a
+    string table: of the values of all the dataframes for categoricals, of
+    the unique values of each dataframe for the other columns.
+    """
+
+    def __init__(self, fname, columns):
+        self.fname = fname
+        self.names = list(columns)
+        self.path = cache_path(fname)
+        # kind of each column, from the dtypes of the first dataframe
+        self.columns = None
+        # codes of the values of each categorical column, by value
+        self.categories = {}
+        # number of strings and size of the blob of each string table
+        self.counts = {}
+        self.sizes = {}
+
+        # the cache is invalid until it is fully written, and the files
+        # of the previous one are appended to
+        os.makedirs(self.path, exist_ok=True)
+        for name in os.listdir(self.path):
+            os.remove(os.path.join(self.path, name))
+
+    def add_strings(self, i, strings):
+        """
+        Appends strings to the string table of the column i.
+        Returns the code of the first one.
+        """
+        code = self.counts.get(i, 0)
+        self.sizes[i] = append_strings(
+            os.path.join(self.path, str(i)), strings, self.sizes.get(i, 0)
+        )
+        self.counts[i] = code + len(strings)
+        return code
+
+    def append(self, df):
+        """
+        Appends the rows of a dataframe of the columns of the cache.
+        """
+        df = df[self.names]
+
+        if self.columns is None:
+            self.columns = []
+            for col in self.names:
+                if df[col].dtype.kind in "biuf":
+                    self.columns.append({
+                        "name": col,
+                        "kind": "numeric",
+                        "dtype": df[col].dtype.str,
+                    })
+                elif pd.api.types.is_categorical_dtype(df[col]):
+                    self.columns.append({"name": col, "kind": "categorical"})
+                else:
+                    self.columns.append({"name": col, "kind": "string"})
+
+        for i, column in enumerate(self.columns):
+            series = df[column["name"]]
+            col_path = os.path.join(self.path, str(i))
+
+            if column["kind"] == "numeric":
+                with open(col_path + ".bin", "ab") as f:
+                    series.values.astype(column["dtype"]).tofile(f)
+                continue
+
+            if column["kind"] == "categorical":
+                categories = self.categories.setdefault(i, {})
+                values = [str(value) for value in series.cat.categories]
+                new_values = [
+                    value for value in values if value not in categories
+                ]
+                first = self.add_strings(i, new_values)
+                categories.update(
+                    (value, first + j) for j, value in enumerate(new_values)
+                )
+
+                local_codes = series.cat.codes.values
+                codes = np.array(
+                    [categories[value] for value in values], dtype=np.int32
+                )
+
+            else:
+                local_codes, uniques = pd.factorize(series)
+                first = self.add_strings(
+                    i, [str(value) for value in uniques]
+                )
+                codes = np.arange(
+                    first, first + len(uniques), dtype=np.int32
+                )
+
+            # the code -1 points to the appended missing value
+            with open(col_path + ".codes.bin", "ab") as f:
+                np.append(codes, np.int32(-1))[local_codes].tofile(f)
+
+    def close(self, delta=False):
+        """
+        Writes the description of the cache, which makes it valid.
+        Must be called once fname is written: the cache is only valid for
+        this version of the file.
+        delta: fname only holds the delta of an incremental cleaning.
+        """
+        if self.columns is None:
+            # no rows: every column is an empty string column
+            self.append(pd.DataFrame(columns=self.names))
+
+        meta = {
+            "source": file_signature(self.fname),
+            "delta": delta,
+            "columns": self.columns,
+        }
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+
+class Dataset():
+    """
+    Cleaned dataset shared by the feeding stages.
+    The csv file (or its cache) is only parsed the first time the dataset
+    is used, and each of its forms only built once.
+    df: the rows of the dataset when they are already loaded, eg. the
+    rows of a category sent to a worker (see db_feeding.feed_category).
+    """
+
+    def __init__(self, fname, headers, df=None):
+        self.fname = fname
+        self.headers = headers
+        self._df = df
+        self._edges = {}
+
+    @property
+    def df(self):
+        """
+        The dataset as a pandas dataframe of the headers columns.
+        """
+        if self._df is None:
+            self._df = read_dataset(self.fname)[self.headers]
+        return self._df
+
+    def edges(self, col):
+        """
+        The (url, name) edges linking the products of the dataset to the
+        names of col (brands or stores), normalized by split_names.
+        Duplicated edges are dropped, edges keep the order of the rows.
+        """
+        if col not in self._edges:
+            names = split_names(self.df[col])
+
+            self._edges[col] = pd.DataFrame(
+                {
+                    "url": self.df["url"].loc[names.index].values,
+                    "name": names.values,
+                },
+                columns=["url", "name"],
+            ).drop_duplicates().reset_index(drop=True)
+
+        return self._edges[col]
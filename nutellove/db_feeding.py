@@ -1,10 +1,20 @@
 # coding: utf8
 
+import argparse
+import csv
 import datetime
+import errno
+import io
+import json
+import multiprocessing
 import os
+import time
 
 import django
+import numpy as np
 import pandas as pd
+from psycopg2.extras import execute_values
+from tqdm import tqdm
 
 # used to execute this file without django running
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "nutellove.settings")
@@ -13,99 +23,502 @@ django.setup()
 # imported avfter django.setup() to let the django apps load first
 # otherwise, we get: django.core.exceptions.AppRegistryNotReady:
 # Apps aren't loaded yet
+from django.core.management.color import no_style
+from django.db import connection, connections, transaction
+from django.db.models import F
 from products.models import *
+from products.controllers import suggestion_candidates
 from constants import *
+from csv_cleaner import commit_state
+from dataset import (
+    Dataset, file_signature, is_delta, record_batches, row_categories,
+)
 
 
 # #####--- FUNCTIONS ----##### #
-def get_unique_df_values(df_name, col_name):
+def batches(iterable, batch_size):
     """
-    Gets unique values from a dataframe.
+    Yields lists of batch_size elements (or less, for the last one)
+    of an iterable.
     """
-    unique_value_list = df_name[col_name].unique()
-    return unique_value_list
+    batch = []
+    for element in iterable:
+        batch.append(element)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
 
+    if batch:
+        yield batch
 
-def csv_to_df(fname, headers):
+
+def bulk_get_or_create(model, field, values, batch_size):
     """
-    Returns a pandas dataframe made from a csv file
+    Creates a row of model for each of the values of its unique field
+    that is not in the database yet.
+    For each batch of values, existing ones are resolved with one query
+    and the missing ones inserted with one bulk_create.
+    Returns the number of created rows.
     """
+    created = 0
+
+    # dict.fromkeys drops duplicates, keeping the order of values
+    for batch in batches(dict.fromkeys(values), batch_size):
+        existing = set(
+            model.objects.filter(
+                **{field + "__in": batch}
+            ).values_list(field, flat=True)
+        )
+
+        new_objs = [
+            model(**{field: value}) for value in batch
+            if value not in existing
+        ]
+        model.objects.bulk_create(new_objs)
+        created += len(new_objs)
 
-    # reads the specified file.
-    # sep: csv file's separator
-    # low_memory: avoiding unnecessary warning msgs
-    csv_file = pd.read_csv(
-        fname,
-        sep=";",
-        encoding="utf-8",
-        low_memory=False
+    return created
+
+
+def link_rows(edges, names_ids, products_ids):
+    """
+    Returns the (product id, brand or store id) rows of edges
+    (see Dataset.edges).
+    names_ids: dict of the brands or stores ids, by name
+    products_ids: dict of the products ids, by url, with all the urls of
+    edges
+    """
+    return list(zip(
+        edges["url"].map(products_ids).tolist(),
+        edges["name"].map(names_ids).tolist(),
+    ))
+
+
+def insert_ignore(cursor, table, columns, rows, batch_size):
+    """
+    Inserts rows (tuples of python values) in a table, batch_size rows
+    per query. Rows conflicting with existing ones are ignored.
+    Returns the number of inserted rows.
+    """
+    sql = "INSERT INTO {} ({}) VALUES %s ON CONFLICT DO NOTHING".format(
+        table, ", ".join(columns)
     )
 
-    # defines a dataframe, from the passed headers
-    df = csv_file[headers]
-    return df
+    inserted = 0
+    for batch in batches(rows, batch_size):
+        execute_values(cursor, sql, batch, page_size=batch_size)
+        inserted += cursor.rowcount
+
+    return inserted
+
+
+def copy_rows(cursor, table, columns, rows, batch_size):
+    """
+    Streams rows (tuples of python values, None for NULL) to a table
+    with COPY FROM STDIN.
+    """
+    sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+        table, ", ".join(columns)
+    )
+    cursor.copy_expert(sql, CopyStream(rows, batch_size))
+
+
+def timestamp_to_datetime(timestamp):
+    """
+    Returns the aware datetime of a unix timestamp
+    """
+    # not a local time made aware: local times are ambiguous when clocks
+    # go back
+    return datetime.datetime.fromtimestamp(
+        timestamp, django.utils.timezone.utc
+    )
+
+
+# Product fields filled from the csv by product_fields
+PRODUCT_FIELDS = [
+    "code",
+    "url",
+    "name",
+    "nutri_grade",
+    "cat_id",
+    "energy",
+    "fat",
+    "carbs",
+    "sugars",
+    "fibers",
+    "proteins",
+    "salt",
+    "img",
+    "img_small",
+    "last_modified_t",
+]
+
+
+def product_values(product, categories, fields):
+    """
+    Returns the values of a Product for the specified model fields,
+    converted for the database as the ORM would do it.
+    """
+    values = product_fields(product, categories)
+    return [
+        field.get_db_prep_save(values[field.attname], connection)
+        for field in fields
+    ]
+
+
+def product_fields(product, categories):
+    """
+    Returns the fields of a Product, from a dict of the csv
+    categories: dict of the categories ids, by name
+    """
+    return {
+        "code": product["code"],
+        "url": product["url"],  # unique
+        "name": product["product_name"],
+        "nutri_grade": product["nutrition_grade_fr"],
+        "cat_id": categories[product["main_category_fr"]],
+        "energy": product["energy_100g"],
+        "fat": product["fat_100g"],
+        "carbs": product["carbohydrates_100g"],
+        "sugars": product["sugars_100g"],
+        "fibers": product["fiber_100g"],
+        "proteins": product["proteins_100g"],
+        "salt": product["salt_100g"],
+        "img": product["image_url"],
+        "img_small": product["image_small_url"],
+        "last_modified_t": timestamp_to_datetime(product["last_modified_t"]),
+    }
 
 
-def csv_to_dict(fname, headers):
+def feed_category(job):
     """
-    Returns a cleaned list of dicts made from a csv
+    Feeds the products of a category, in a worker process with its own
+    database connection.
+    job: a tuple (category, df, delta, batch_size), df being the rows of
+    the category (see row_categories)
+    Returns the summaries of the whole job and of each of its stages, and
+    the ids of the categories it changed.
     """
+    category, df, delta, batch_size = job
 
-    # reads the specified file.
-    # sep: csv file's separator
-    # low_memory: avoiding unnecessary warning msgs
-    csv_file = pd.read_csv(
-        fname,
-        sep=";",
-        encoding="utf-8",
-        low_memory=False
+    with StageStats("feed", category) as total:
+        dbf = DBFeed(
+            CLEANED_CSV_FILE, HEADERS_LIST,
+            batch_size=batch_size, category=category, df=df,
+        )
+        try:
+            if delta:
+                dbf.update_products()
+            else:
+                dbf.fill_products()
+        finally:
+            # the process outlives the job, its connection is not reused
+            connection.close()
+
+    return (
+        total.summary(),
+        [stats.summary() for stats in dbf.stats],
+        dbf.changed_categories,
     )
 
-    # Soft conversion of columns to pandas objects
-    df_to_objects = csv_file.astype(object).infer_objects()
 
-    # replace nan fields by None python type
-    fill_nan_as_none = df_to_objects.where((pd.notnull(csv_file)), None)
+def bump_catalog_generation():
+    """
+    Increments the generation of the catalog: the searches cached before
+    the database was fed are not read anymore.
+    """
+    CatalogVersion.objects.update(generation=F("generation") + 1)
 
-    # dict conversion of pandas dataframe as records (list of dicts)
-    # [{k1:v1, kn:vn}, {k1:v1, kn:vn}]
-    csv_dict = fill_nan_as_none[headers].to_dict(orient="records")
 
-    # transforms commas seperated values to list for brands and stores
-    # list comprehension to strip spaces from strings in list
-    for dictionary in csv_dict:
-        if dictionary["brands"] is not None:
-            dictionary["brands"] = [
-                brand.strip()
-                for brand
-                in dictionary["brands"].split(',')
-            ]
+def reset_peak_rss():
+    """
+    Resets the peak RSS of the process to its current RSS.
+    Returns False where it can not be reset (out of linux).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
 
-        if dictionary["stores"] is not None:
-            dictionary["stores"] = [
-                store.strip()
-                for store
-                in dictionary["stores"].split(',')
-            ]
+def peak_rss():
+    """
+    Returns the peak RSS of the process since its last reset, in kilobytes.
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
 
-    return csv_dict
+
+def write_stats(fname, stages, elapsed, queries, **run):
+    """
+    Saves the summary of a feeding run to a json file, and prints it.
+    stages: the summaries of the stages (see StageStats.summary)
+    elapsed, queries: measured on the whole run, queries run outside of
+    the stages included
+    run: the options of the run, saved as they are
+    """
+    summary = dict(
+        run,
+        elapsed=round(elapsed, 3),
+        queries=queries,
+        stages=stages,
+    )
+    with open(fname, "w") as f:
+        json.dump(summary, f, indent=4)
+
+    for stage in stages:
+        name = " ".join(filter(None, [stage["stage"], stage["category"]]))
+        print(
+            "{}: {rows} rows ({written} written, {skipped} skipped) "
+            "in {elapsed}s, {rows_per_s} rows/s, {queries} queries".format(
+                name, **stage
+            )
+        )
+    print("Fed in {elapsed}s, {queries} queries".format(**summary))
 
 
 # #####--- CLASSES ----##### #
+class StageStats():
+    """
+    Measures a stage of the feeding, used as a context manager around it:
+    elapsed time, SQL queries and peak RSS of the process during the stage
+    (None where it can not be reset), plus the rows processed and written
+    (inserted, updated or deleted) counted by the stage, the other rows
+    being skipped.
+    COPY statements do not go through django and are not counted as
+    queries.
+    """
+
+    # stages being measured in this process, innermost last
+    active = []
+
+    def __init__(self, stage, category=None):
+        self.stage = stage
+        self.category = category
+        self.rows = 0
+        self.written = 0
+        self.queries = 0
+        self.elapsed = 0
+        self.peak_rss = 0
+
+    def count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    @classmethod
+    def record_peak_rss(cls):
+        """
+        Records the peak RSS since the last reset in the active stages.
+        """
+        measured = [
+            stats for stats in cls.active if stats.peak_rss is not None
+        ]
+        if measured:
+            peak = peak_rss()
+            for stats in measured:
+                stats.peak_rss = max(stats.peak_rss, peak)
+
+    def __enter__(self):
+        # the peak so far is the one of the stages this one is nested in
+        self.record_peak_rss()
+        if not reset_peak_rss():
+            self.peak_rss = None
+        self.active.append(self)
+
+        self.wrapper = connection.execute_wrapper(self.count_query)
+        self.wrapper.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
+        self.record_peak_rss()
+        self.active.remove(self)
+        return self.wrapper.__exit__(*exc_info)
+
+    def summary(self):
+        """
+        Returns the measures of the stage as a dict.
+        """
+        return {
+            "stage": self.stage,
+            "category": self.category or "",
+            "rows": self.rows,
+            "written": self.written,
+            "skipped": self.rows - self.written,
+            "elapsed": round(self.elapsed, 3),
+            "rows_per_s": (
+                round(self.rows / self.elapsed) if self.elapsed else 0
+            ),
+            "queries": self.queries,
+            "peak_rss": self.peak_rss,
+        }
+
+
+class CopyStream():
+    """
+    File-like object reading rows as csv, batch_size rows at a time,
+    so that COPY never needs the whole table in memory.
+    """
+
+    def __init__(self, rows, batch_size):
+        self.batches = batches(rows, batch_size)
+        self.buffer = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                batch = next(self.batches)
+            except StopIteration:
+                break
+
+            # an unquoted empty field is a NULL for COPY csv
+            lines = io.StringIO()
+            csv.writer(lines).writerows(batch)
+            self.buffer += lines.getvalue()
+
+        if size < 0:
+            size = len(self.buffer)
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    readline = read
+
+
 class DBFeed():
-    def __init__(self, file_name, headers):
+    def __init__(self, file_name, headers, batch_size=FEED_BATCH_SIZE,
+                 category=None, df=None):
         self.file_name = os.path.abspath(file_name)
         self.headers = headers
+        # only feeds the products of a category, whose rows are df,
+        # see feed_category
+        self.category = category
+        # parsed once, when a stage first needs it
+        self.dataset = Dataset(self.file_name, headers, df=df)
+        # number of rows resolved and inserted per query and transaction
+        self.batch_size = batch_size
+        # identifies the version of the file in the checkpoints
+        signature = file_signature(self.file_name)
+        if signature is None:
+            raise FileNotFoundError(
+                errno.ENOENT, os.strerror(errno.ENOENT), self.file_name
+            )
+        self.source = "{size}:{mtime_ns}".format(**signature)
+        # StageStats of the stages run, in their order
+        self.stats = []
+        # ids of the categories whose products were created, updated or
+        # deleted, see fill_substitutes
+        self.changed_categories = set()
+
+    def measure(self, stage):
+        """
+        Returns the StageStats of a new stage.
+        """
+        stats = StageStats(stage, self.category)
+        self.stats.append(stats)
+        return stats
+
+    def run_batches(self, stage, rows, process, resume=True):
+        """
+        Calls process (returns the number of rows it wrote) on rows, batch
+        by batch, each batch in a transaction saving the stage checkpoint.
+        rows: a list, or a dataframe whose batches are lists of dicts (see
+        dataset.record_batches).
+        resume: False when rows are computed from the database.
+        """
+        if resume:
+            checkpoint, created = FeedCheckpoint.objects.get_or_create(
+                stage=stage, category=self.category or "",
+                defaults={"source": self.source},
+            )
+        else:
+            checkpoint = FeedCheckpoint(stage=stage, source=self.source)
+
+        # the checkpoint of another version of the file is meaningless
+        if checkpoint.source != self.source:
+            checkpoint.source = self.source
+            checkpoint.offset = 0
+
+        if checkpoint.offset:
+            print("Resuming {} at row {}".format(
+                " ".join(filter(None, [stage, self.category])),
+                checkpoint.offset,
+            ))
+
+        with self.measure(stage) as stats, tqdm(
+            total=len(rows), initial=checkpoint.offset, desc=stage,
+            unit="rows", disable=self.category is not None,
+        ) as progress_bar:
+            if isinstance(rows, pd.DataFrame):
+                rows_batches = record_batches(
+                    rows, self.batch_size, checkpoint.offset
+                )
+            else:
+                rows_batches = batches(
+                    rows[checkpoint.offset:], self.batch_size
+                )
+
+            for batch in rows_batches:
+                with transaction.atomic():
+                    written = process(batch)
+                    checkpoint.offset += len(batch)
+                    if resume:
+                        checkpoint.save()
+
+                stats.rows += len(batch)
+                stats.written += written
+                progress_bar.update(len(batch))
+
+    def ids(self, model, field, values):
+        """
+        Returns a dict of the ids of the rows of model, by field.
+        Loads the whole table, or only the rows of values when feeding a
+        category: the other workers have no use of the rest.
+        """
+        if self.category is None:
+            return dict(model.objects.values_list(field, "id"))
+
+        ids = {}
+        for batch in batches(set(values), self.batch_size):
+            ids.update(
+                model.objects.filter(
+                    **{field + "__in": batch}
+                ).values_list(field, "id")
+            )
+        return ids
+
+    def change_categories(self, categories):
+        """
+        Records the categories of the products of the csv as changed.
+        categories: dict of the categories ids, by name
+        """
+        names = self.dataset.df["main_category_fr"].dropna().unique()
+        self.changed_categories.update(categories[name] for name in names)
+
+    def clear_checkpoints(self):
+        """
+        Deletes the checkpoints, once a run is over.
+        """
+        FeedCheckpoint.objects.all().delete()
 
     def fill_categories(self, categories_col):
         """
         Fills Categories table with specified categories column
         """
         print("Feeding categories...")
-        cat_dict = csv_to_dict(self.file_name, self.headers)
+        categories_list = self.dataset.df[categories_col].dropna().unique()
 
-        for category in cat_dict:
-            Category.objects.get_or_create(name=category[categories_col])
+        self.run_batches(
+            "categories", list(categories_list),
+            lambda batch: bulk_get_or_create(
+                Category, "name", batch, self.batch_size
+            ),
+        )
 
         print("Categories fed")
 
@@ -115,22 +528,14 @@ class DBFeed():
         Fills the table with unique values.
         """
         print("Feeding stores...")
-        dataframe = csv_to_df(self.file_name, self.headers)
-        stores_list = get_unique_df_values(dataframe, stores_col)
+        stores_set = set(self.dataset.edges(stores_col)["name"])
 
-        # stores splitting
-        stores_list_split = [
-            i.split(",") for i in stores_list if type(i) is not float
-        ]
-
-        # stores cleaning
-        stores_set = set()
-        for stores_list in stores_list_split:
-            for store in stores_list:
-                stores_set.add(store.strip().capitalize())
-
-        for store in stores_set:
-            Store.objects.get_or_create(name=store)
+        self.run_batches(
+            "stores", sorted(stores_set),
+            lambda batch: bulk_get_or_create(
+                Store, "name", batch, self.batch_size
+            ),
+        )
 
         print("Stores fed")
 
@@ -139,24 +544,15 @@ class DBFeed():
         Fills brands table with specified brands (brands_col).
         Fills the table with unique values.
         """
-
         print("Feeding brands...")
-        dataframe = csv_to_df(self.file_name, self.headers)
-        brands_list = get_unique_df_values(dataframe, brands_col)
+        brands_set = set(self.dataset.edges(brands_col)["name"])
 
-        # brands splitting
-        brands_list_split = [
-            i.split(",") for i in brands_list if type(i) is not float
-        ]
-
-        # brands cleaning
-        brands_set = set()
-        for brands_list in brands_list_split:
-            for brand in brands_list:
-                brands_set.add(brand.strip().capitalize())
-
-        for brand in brands_set:
-            Brand.objects.get_or_create(name=brand)
+        self.run_batches(
+            "brands", sorted(brands_set),
+            lambda batch: bulk_get_or_create(
+                Brand, "name", batch, self.batch_size
+            ),
+        )
 
         print("Brands fed")
 
@@ -166,157 +562,618 @@ class DBFeed():
         """
 
         print("Feeding products...")
-        products_dict = csv_to_dict(self.file_name, self.headers)
-
-        for product in products_dict:
-            Product.objects.get_or_create(
-                code=product["code"],
-                url=product["url"],  # unique
-                name=product["product_name"],
-                nutri_grade=product["nutrition_grade_fr"],
-                cat=Category.objects.get(
-                    name=product["main_category_fr"]
-                ),
-                energy=product["energy_100g"],
-                fat=product["fat_100g"],
-                carbs=product["carbohydrates_100g"],
-                sugars=product["sugars_100g"],
-                fibers=product["fiber_100g"],
-                proteins=product["proteins_100g"],
-                salt=product["salt_100g"],
-                img=product["image_url"],
-                img_small=product["image_small_url"],
-                last_modified_t=django.utils.timezone.make_aware(
-                    datetime.datetime.fromtimestamp(product["last_modified_t"])
-                ),
+        categories = dict(Category.objects.values_list("name", "id"))
+        self.change_categories(categories)
+
+        # urls already fed, a product is only created once
+        seen_urls = set()
+
+        def feed(batch):
+            batch_urls = [product["url"] for product in batch]
+            seen_urls.update(
+                Product.objects.filter(
+                    url__in=batch_urls
+                ).values_list("url", flat=True)
             )
 
+            new_products = []
+            for product in batch:
+                if product["url"] not in seen_urls:
+                    seen_urls.add(product["url"])
+                    new_products.append(
+                        Product(**product_fields(product, categories))
+                    )
+
+            Product.objects.bulk_create(new_products)
+            return len(new_products)
+
+        self.run_batches("products", self.dataset.df, feed)
+
         print("Products fed")
 
-        self.fill_productsbrands(products_dict)
-        self.fill_productsstores(products_dict)
+        urls = self.dataset.df["url"].unique()
+        self.fill_productsbrands(urls)
+        self.fill_productsstores(urls)
 
-    def fill_productsbrands(self, products_dict):
-        # this loop gets all dicts in the products_dict list.
-        # for each dict if the brands value is not None,
-        # for each brand, get or create the productsbrands table
-        # based on brand name and product name of each dict.
+    def copy_products(self):
+        """
+        Loads products and their brands and stores links with COPY,
+        much faster than inserts. Only for an empty Products table,
+        eg. to rebuild the catalog from scratch: categories, brands and
+        stores must be fed first.
+        """
+        print("Copying products...")
+        df = self.dataset.df
+        categories = dict(Category.objects.values_list("name", "id"))
+        self.change_categories(categories)
+        brands = dict(Brand.objects.values_list("name", "id"))
+        stores = dict(Store.objects.values_list("name", "id"))
 
-        print("Feeding productsbrands...")
-        for dic in products_dict:
-            if dic["brands"] is not None:
-                for brand in dic["brands"]:
-                    # get or create brands and products id
-                    Product.brands.through.objects.get_or_create(
-                        # select brands.id
-                        # from Brands table
-                        # where brands.name = brand
-                        brand=Brand.objects.get(
-                            name=brand.lower().capitalize()
-                        ),
-                        # select product.id
-                        # from Products table
-                        # where products.name = dic["url"]
-                        product=Product.objects.get(
-                            url=dic["url"]
-                        )
+        fields = [Product._meta.get_field(name) for name in PRODUCT_FIELDS]
+
+        # a product is only copied once, with the id it gets here
+        products = {}
+
+        def products_rows():
+            for batch in record_batches(df, self.batch_size):
+                for product in batch:
+                    if product["url"] in products:
+                        continue
+                    product_id = products[product["url"]] = len(products) + 1
+
+                    yield (
+                        [product_id] +
+                        product_values(product, categories, fields)
                     )
 
+        with self.measure("copy_products") as stats, \
+                transaction.atomic(), connection.cursor() as cursor:
+            # no other process can insert products during the copy
+            cursor.execute(
+                "LOCK TABLE products_product IN SHARE ROW EXCLUSIVE MODE"
+            )
+            if Product.objects.exists():
+                raise RuntimeError(
+                    "products can only be copied to an empty table"
+                )
+
+            # foreign keys are checked once, at commit
+            cursor.execute("SET CONSTRAINTS ALL DEFERRED")
+
+            copy_rows(
+                cursor, Product._meta.db_table,
+                ["id"] + [field.column for field in fields],
+                products_rows(), self.batch_size,
+            )
+            copy_rows(
+                cursor, Product.brands.through._meta.db_table,
+                ["product_id", "brand_id"],
+                link_rows(self.dataset.edges("brands"), brands, products),
+                self.batch_size,
+            )
+            copy_rows(
+                cursor, Product.stores.through._meta.db_table,
+                ["product_id", "store_id"],
+                link_rows(self.dataset.edges("stores"), stores, products),
+                self.batch_size,
+            )
+
+            # ids were given by the copy, not by the products sequence
+            for sql in connection.ops.sequence_reset_sql(
+                no_style(), [Product]
+            ):
+                cursor.execute(sql)
+
+            stats.rows = len(df)
+            stats.written = len(products)
+
+        print("Products copied")
+
+    def links(self, model, col, urls):
+        """
+        Returns the (product id, brand or store id) rows linking the
+        products of urls to their brands or stores (col, of model).
+        """
+        edges = self.dataset.edges(col)
+        edges = edges[edges["url"].isin(urls)]
+
+        names = self.ids(model, "name", edges["name"].unique())
+        products = self.ids(Product, "url", edges["url"].unique())
+
+        return link_rows(edges, names, products)
+
+    def fill_productsbrands(self, urls):
+        # links each product of urls to its brands.
+        # names and urls are resolved to ids with dicts loaded once,
+        # and links inserted in batches, existing ones being ignored.
+
+        print("Feeding productsbrands...")
+        rows = self.links(Brand, "brands", urls)
+
+        with connection.cursor() as cursor:
+            self.run_batches(
+                "productsbrands", rows,
+                lambda batch: insert_ignore(
+                    cursor, Product.brands.through._meta.db_table,
+                    ["product_id", "brand_id"], batch, self.batch_size,
+                ),
+            )
+
         print("Productsbrands fed")
 
-    def fill_productsstores(self, products_dict):
-        # this loop gets all dicts in the products_dict list.
-        # for each dict if the brands value is not None,
-        # for each store, get or create the productsstores table
-        # based on store name and product name of each dict.
+    def fill_productsstores(self, urls):
+        # links each product of urls to its stores.
+        # names and urls are resolved to ids with dicts loaded once,
+        # and links inserted in batches, existing ones being ignored.
 
         print("Feeding productsstores...")
-        for dic in products_dict:
-            if dic["stores"] is not None:
-                for store in dic["stores"]:
-                    # get or create stores and products id
-                    Product.stores.through.objects.get_or_create(
-                        # select stores.id
-                        # from stores table
-                        # where stores.name = store
-                        store=Store.objects.get(
-                            name=store.lower().capitalize()
-                        ),
-                        # select products.id
-                        # from Products table
-                        # where products.name = dic["url"]
-                        product=Product.objects.get(
-                            url=dic["url"]
+        rows = self.links(Store, "stores", urls)
+
+        with connection.cursor() as cursor:
+            self.run_batches(
+                "productsstores", rows,
+                lambda batch: insert_ignore(
+                    cursor, Product.stores.through._meta.db_table,
+                    ["product_id", "store_id"], batch, self.batch_size,
+                ),
+            )
+
+        print("Productsstores fed")
+
+    def delete_stale_links(self, urls):
+        """
+        Deletes the brands and stores links of the products of urls that
+        are not in the dataset anymore.
+        """
+        products = self.ids(Product, "url", urls)
+        product_ids = sorted(products[url] for url in set(urls))
+
+        with connection.cursor() as cursor:
+            for through, model, col in (
+                (Product.brands.through, Brand, "brands"),
+                (Product.stores.through, Store, "stores"),
+            ):
+                table = through._meta.db_table
+                other_column = through._meta.get_field(
+                    col[:-1]
+                ).column
+
+                # links of the dataset, by product id
+                rows = np.array(
+                    self.links(model, col, urls), dtype=np.int64
+                ).reshape(-1, 2)
+                rows = rows[rows[:, 0].argsort(kind="mergesort")]
+
+                def delete(batch):
+                    start = rows[:, 0].searchsorted(batch[0])
+                    end = rows[:, 0].searchsorted(batch[-1], side="right")
+
+                    # links of the batch products, not in the batch rows
+                    cursor.execute(
+                        """
+                        DELETE FROM {table} AS link
+                        WHERE link.product_id = ANY(%s)
+                        AND NOT EXISTS (
+                            SELECT 1
+                            FROM unnest(%s::integer[], %s::integer[])
+                            AS new (product_id, other_id)
+                            WHERE new.product_id = link.product_id
+                            AND new.other_id = link.{other}
                         )
+                        RETURNING link.product_id
+                        """.format(table=table, other=other_column),
+                        [
+                            batch,
+                            rows[start:end, 0].tolist(),
+                            rows[start:end, 1].tolist(),
+                        ]
                     )
 
-        print("Productsstores fed")
+                    # products of the batch which had stale links
+                    return len({row[0] for row in cursor.fetchall()})
+
+                self.run_batches("stale_" + col, product_ids, delete)
+
+    def delete_ids(self, stage, model, ids):
+        """
+        Deletes the rows of model of ids, with one DELETE ... WHERE id IN
+        per batch, and per relation cascading from model.
+        """
+        self.run_batches(
+            stage, sorted(ids),
+            lambda batch: model.objects.filter(
+                id__in=batch
+            ).delete()[1].get(model._meta.label, 0),
+            resume=False,
+        )
+
+    def check_catalog(self):
+        """
+        Raises ValueError unless the csv holds the whole catalog, as
+        recorded by the cleaning which wrote it.
+        """
+        delta = is_delta(self.file_name)
+
+        if delta is None:
+            raise ValueError(
+                "{} changed since it was cleaned, it may not hold the whole "
+                "catalog: clean it again".format(self.file_name)
+            )
+        if delta:
+            raise ValueError(
+                "{} holds the delta of an incremental cleaning, not the "
+                "whole catalog".format(self.file_name)
+            )
+
+    def reconcile(self):
+        """
+        Deletes what left the cleaned csv, which must hold the whole
+        catalog (see check_catalog): the brands and stores links of its
+        products which are not in their lists anymore, the products which
+        are not in the csv, and the brands and stores of none of its
+        products.
+        What to delete is the set difference between the database and the
+        csv, deleted by batches of ids.
+        Favorites of deleted products are deleted with them.
+        """
+        print("Reconciling...")
+        self.check_catalog()
+        urls = self.dataset.df["url"].unique()
+
+        self.delete_stale_links(urls)
+
+        urls = set(urls)
+        stale_products = [
+            (product_id, category_id)
+            for url, product_id, category_id in Product.objects.values_list(
+                "url", "id", "cat_id"
+            )
+            if url not in urls
+        ]
+        self.changed_categories.update(
+            category_id for product_id, category_id in stale_products
+        )
+        self.delete_ids("stale_products", Product, [
+            product_id for product_id, category_id in stale_products
+        ])
+
+        for model, col in ((Brand, "brands"), (Store, "stores")):
+            names = set(self.dataset.edges(col)["name"])
+            self.delete_ids("orphan_" + col, model, [
+                name_id
+                for name, name_id in model.objects.values_list("name", "id")
+                if name not in names
+            ])
 
-    def delete_productsstores(self, products_dict):
-        for t in Stores.objects.select():
-            b = t.product_id
-            s = Product.objects.get(Product.id == b)
-            print(s.id)
-            # for dic in products_dict:
-            #     if dic["stores"] is not None:
-            #         for store in dic["stores"]:
-            #             print(store)
-            # list every brands for each product, check if it is in the csv,
-            # else delete the row that is not in the csv
+        print("Reconciled")
 
     def update_products(self):
         """
-        Fills Products table with specified
+        Creates the products of the csv that are not in the database yet,
+        and updates the ones modified since they were fed.
+        Used to feed the delta written by an incremental cleaning.
+        Each batch is compared to the database on url and last_modified_t
+        with one query, and changes written with one upsert. Brands and
+        stores links of the changed products are reconciled at the end.
         """
-        products_dict = csv_to_dict(self.file_name, self.headers)
+        print("Updating products...")
+        categories = dict(Category.objects.values_list("name", "id"))
+        self.change_categories(categories)
+        fields = [Product._meta.get_field(name) for name in PRODUCT_FIELDS]
+        columns = [field.column for field in fields]
+
+        # the most recent version of each product (the first one, when
+        # several are), in the order of the first rows of their urls
+        df = self.dataset.df.reset_index(drop=True)
+        products = df.loc[
+            df.groupby("url", sort=False)["last_modified_t"].idxmax().values
+        ]
 
-        for product_from_csv in products_dict:
-            product_from_db = Product.objects.get(url=product_from_csv["url"])
+        sql = """
+            INSERT INTO {table} ({columns}) VALUES %s
+            ON CONFLICT (url) DO UPDATE SET {updates}
+            WHERE {table}.last_modified_t < EXCLUDED.last_modified_t
+        """.format(
+            table=Product._meta.db_table,
+            columns=", ".join(columns),
+            updates=", ".join(
+                "{0} = EXCLUDED.{0}".format(column)
+                for column in columns if column != "url"
+            ),
+        )
 
-            if (
-                product_from_db.last_modified_t <
-                product_from_csv["last_modified_t"]
-            ):
+        last_modified_index = PRODUCT_FIELDS.index("last_modified_t")
+
+        with connection.cursor() as cursor:
+            def upsert(batch):
+                existing = {
+                    url: (last_modified_t, category_id)
+                    for url, last_modified_t, category_id
+                    in Product.objects.filter(
+                        url__in=[product["url"] for product in batch]
+                    ).values_list("url", "last_modified_t", "cat_id")
+                }
+
+                rows = []
+                for product in batch:
+                    values = product_values(product, categories, fields)
+                    last_modified_t = values[last_modified_index]
+
+                    if product["url"] not in existing:
+                        rows.append(values)
+                    elif existing[product["url"]][0] < last_modified_t:
+                        rows.append(values)
+                        # the category the product may leave
+                        self.changed_categories.add(
+                            existing[product["url"]][1]
+                        )
+
+                if not rows:
+                    return 0
+
+                execute_values(cursor, sql, rows, page_size=len(rows))
+                return cursor.rowcount
+
+            self.run_batches("update_products", products, upsert)
+
+        print("Products updated")
+
+        # the products now at the version of the csv, including the ones
+        # updated by a previous run which stopped before their links
+        changed = []
+        versions = zip(
+            products["url"].tolist(), products["last_modified_t"].tolist()
+        )
+        for batch in batches(versions, self.batch_size):
+            last_modified = dict(
+                Product.objects.filter(
+                    url__in=[url for url, _ in batch]
+                ).values_list("url", "last_modified_t")
+            )
+            changed.extend(
+                url for url, last_modified_t in batch
+                if last_modified[url] ==
+                timestamp_to_datetime(last_modified_t)
+            )
+
+        self.fill_productsbrands(changed)
+        self.fill_productsstores(changed)
+        self.delete_stale_links(changed)
+
+    def fill_substitutes(self, categories):
+        """
+        Computes again the substitutes of the products of categories (ids),
+        one statement per batch of categories.
+        """
+        print("Feeding substitutes...")
+
+        with connection.cursor() as cursor:
+            def compute(batch):
+                cursor.execute(
+                    """
+                    DELETE FROM products_substitute AS substitute
+                    USING products_product AS product
+                    WHERE substitute.product_id = product.id
+                    AND product.cat_id = ANY(%(categories)s)
+                    """,
+                    {"categories": batch},
+                )
+                cursor.execute(
+                    """
+                    WITH words AS (
+                        SELECT
+                            id, cat_id, nutri_grade, name,
+                            unnest(tsvector_to_array(search_vector)) AS word
+                        FROM products_product
+                        WHERE cat_id = ANY(%(categories)s)
+                    ), candidates AS (
+                        SELECT * FROM (
+                            SELECT words.*, row_number() OVER (
+                                PARTITION BY cat_id, word
+                                ORDER BY nutri_grade, id
+                            ) AS word_rank
+                            FROM words
+                        ) AS ranked
+                        WHERE word_rank <= %(count)s
+                    ), pairs AS (
+                        SELECT
+                            product.id AS product_id,
+                            other.id AS substitute_id,
+                            other.nutri_grade,
+                            count(*) AS shared
+                        FROM words AS product
+                        JOIN candidates AS other
+                        ON other.cat_id = product.cat_id
+                        AND other.word = product.word
+                        AND other.nutri_grade <= product.nutri_grade
+                        AND other.name <> product.name
+                        GROUP BY product.id, other.id, other.nutri_grade
+                    )
+                    INSERT INTO products_substitute
+                    (product_id, substitute_id, rank)
+                    SELECT product_id, substitute_id, rank
+                    FROM (
+                        SELECT product_id, substitute_id, row_number() OVER (
+                            PARTITION BY product_id
+                            ORDER BY nutri_grade, shared DESC, substitute_id
+                        ) AS rank
+                        FROM pairs
+                    ) AS ranked
+                    WHERE rank <= %(count)s
+                    """,
+                    {"categories": batch, "count": SUBSTITUTES_COUNT},
+                )
+                return len(batch)
+
+            self.run_batches(
+                "substitutes", sorted(categories), compute, resume=False
+            )
+
+        print("Substitutes fed")
+
+    def fill_suggestions(self):
+        """
+        Draws again the pool of the products suggested by Search when the
+        query is empty: SUGGESTIONS_COUNT products at random among the
+        ones that can be suggested, with one INSERT ... SELECT.
+        """
+        print("Feeding suggestions...")
+        sql, params = suggestion_candidates().order_by(
+            "?"
+        ).values("id")[:SUGGESTIONS_COUNT].query.sql_with_params()
+
+        with self.measure("suggestions") as stats, transaction.atomic(), \
+                connection.cursor() as cursor:
+            cursor.execute("DELETE FROM products_suggestion")
+            cursor.execute(
+                "INSERT INTO products_suggestion (product_id) " + sql, params
+            )
+            stats.rows = stats.written = cursor.rowcount
 
-                product_from_db.code = product_from_csv["code"]
-                product_from_db.url = product_from_csv["url"]
-                product_from_db.name = product_from_csv["product_name"]
-                product_from_db.nutri_grade = product_from_csv[
-                    "nutrition_grade_fr"
-                ]
-                product_from_db.cat = Category.objects.get(
-                    Category.objects.name == product_from_csv[
-                        "main_category_fr"
-                    ]
-                ).id
-                product_from_db.energy = product_from_csv["energy_100g"]
-                product_from_db.fat = product_from_csv["fat_100g"]
-                product_from_db.carbs = product_from_csv["carbohydrates_100g"]
-                product_from_db.sugars = product_from_csv["sugars_100g"]
-                product_from_db.fibers = product_from_csv["fiber_100g"]
-                product_from_db.proteins = product_from_csv["proteins_100g"]
-                product_from_db.salt = product_from_csv["salt_100g"]
-                product_from_db.salt = product_from_csv["image_url"]
-                product_from_db.salt = product_from_csv["image_small_url"]
-                product_from_db.last_modified_t = product_from_csv[
-                    "last_modified_t"
-                ]
-                product_from_db.save()
-
-                self.fill_brands("brands")
-                self.fill_stores("stores")
-                self.fill_productsbrands(products_dict)
-                self.fill_productsstores(products_dict)
-
-
-def main():
-    dbf = DBFeed(CLEANED_CSV_FILE, HEADERS_LIST)
-
-    dbf.fill_categories("main_category_fr")
-    dbf.fill_stores("stores")
-    dbf.fill_brands("brands")
-    dbf.fill_products()
+        print("Suggestions fed")
+
+
+def main(delta=False, batch_size=FEED_BATCH_SIZE, copy=False,
+         workers=None, reconcile=False):
+    """
+    Feeds the database with the cleaned csv, and saves the measures of
+    its stages to FEED_STATS_FILE.
+    delta: creates or updates the products of an incremental cleaning
+    copy: loads the products with COPY, in an empty Products table
+    workers: number of processes feeding the products, by category
+    reconcile: deletes what left the csv, which holds the whole catalog
+    The state of the cleaning is saved for the next incremental one with
+    delta or copy, which leave the products up to date.
+    """
+    if delta and reconcile:
+        raise ValueError("a delta can not be reconciled with the database")
+    if not delta and is_delta(CLEANED_CSV_FILE):
+        # filling its products would ignore the modified ones, which
+        # already exist
+        raise ValueError(
+            "{} holds the delta of an incremental cleaning: feed it with "
+            "--delta".format(CLEANED_CSV_FILE)
+        )
+
+    # summaries of the jobs of the workers, and of their stages
+    jobs_stats = []
+    workers_stages = []
+    # ids of the categories changed by the workers
+    workers_categories = set()
+
+    with StageStats("feed") as total:
+        dbf = DBFeed(CLEANED_CSV_FILE, HEADERS_LIST, batch_size=batch_size)
+        if reconcile:
+            # before anything is fed
+            dbf.check_catalog()
+
+        # before the first write, in case the run stops halfway, and once
+        # over, for the searches cached while it ran
+        bump_catalog_generation()
+
+        # fed once, before the workers, so that they never create the
+        # same rows
+        dbf.fill_categories("main_category_fr")
+        dbf.fill_stores("stores")
+        dbf.fill_brands("brands")
+
+        if workers is not None and not copy:
+            # the dataset is split once, each worker gets the rows of its
+            # category
+            df = dbf.dataset.df
+            rows_categories = row_categories(df)
+            positions = df.groupby(rows_categories.values).indices
+
+            # biggest categories first, so that they do not end the run alone
+            categories = rows_categories.value_counts().index
+            jobs = (
+                (category, df.iloc[positions[category]], delta, batch_size)
+                for category in categories
+            )
+
+            # forked workers must not share the connection of this process
+            connections.close_all()
+
+            with multiprocessing.Pool(workers) as pool:
+                for job_stats, stages, changed in tqdm(
+                    pool.imap_unordered(feed_category, jobs),
+                    total=len(categories), desc="categories",
+                    unit="categories",
+                ):
+                    jobs_stats.append(job_stats)
+                    workers_stages.extend(stages)
+                    workers_categories.update(changed)
+        elif delta:
+            dbf.update_products()
+        elif copy:
+            dbf.copy_products()
+        else:
+            dbf.fill_products()
+
+        if reconcile:
+            dbf.reconcile()
+
+        dbf.fill_substitutes(dbf.changed_categories | workers_categories)
+        dbf.fill_suggestions()
+
+        dbf.clear_checkpoints()
+        bump_catalog_generation()
+
+        # the next incremental cleaning starts from this csv, once its
+        # products are up to date: filling them ignores the ones which
+        # already exist, and they are cleaned again until updated
+        if delta or copy:
+            commit_state(dbf.file_name)
+
+    write_stats(
+        FEED_STATS_FILE,
+        [stats.summary() for stats in dbf.stats] + workers_stages,
+        total.elapsed,
+        total.queries + sum(job["queries"] for job in jobs_stats),
+        file=dbf.file_name, delta=delta, copy=copy, workers=workers,
+        reconcile=reconcile, batch_size=batch_size, jobs=jobs_stats,
+    )
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description="Feeds the database with db_file.csv"
+    )
+    parser.add_argument(
+        "-d", "--delta",
+        action="store_true",
+        help="creates or updates the products of an incremental cleaning",
+    )
+    parser.add_argument(
+        "-b", "--batch-size",
+        type=int,
+        default=FEED_BATCH_SIZE,
+        help="number of rows resolved and inserted per query",
+    )
+    parser.add_argument(
+        "-c", "--copy",
+        action="store_true",
+        help="loads the products with COPY, to rebuild an empty catalog",
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        nargs="?",
+        const=os.cpu_count(),
+        help="feeds the products of each category in parallel "
+        "(defaults to the number of cores)",
+    )
+    parser.add_argument(
+        "-r", "--reconcile",
+        action="store_true",
+        help="deletes the links, products, brands and stores not in the csv",
+    )
+    args = parser.parse_args()
+
+    if args.delta and args.reconcile:
+        parser.error("--reconcile needs the whole catalog, not a --delta")
+
+    main(
+        delta=args.delta, batch_size=args.batch_size, copy=args.copy,
+        workers=args.workers, reconcile=args.reconcile,
+    )
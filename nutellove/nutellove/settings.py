@@ -46,6 +46,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'debug_toolbar',
     'products',
     'users',
@@ -160,6 +161,38 @@ STATICFILES_DIRS = [
 
 INTERNAL_IPS = ['127.0.0.1', 'localhost']
 
+# how the Search view finds products by name:
+# - "fulltext": ranked full-text search, in french, on an indexed vector
+# - "trigram": names containing the query or similar to it (typos),
+#   on a trigram index of the names
+# - "icontains": names containing the query, on the same trigram index
+PRODUCTS_SEARCH_BACKEND = "fulltext"
+
+# similarity (0 to 1) of a name to the query above which the "trigram"
+# search matches it, the lower the more typos are tolerated
+PRODUCTS_TRIGRAM_CUTOFF = 0.3
+
+# number of products better than the chosen one the search displays at
+# most, when they are not its substitutes computed by db_feeding.py
+PRODUCTS_BETTER_COUNT = 30
+
+# cache of the search results, in memory by default: set CACHE_BACKEND and
+# CACHE_LOCATION to share it between processes, eg. with memcached
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get(
+            'CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+# seconds a search result is cached, it is not read anymore once the
+# catalog is fed again (see products.models.CatalogVersion)
+PRODUCTS_SEARCH_CACHE_TIMEOUT = int(
+    os.environ.get('PRODUCTS_SEARCH_CACHE_TIMEOUT', 15 * 60)
+)
+
 
 if os.environ.get('ENV') == 'PRODUCTION':
 
@@ -1,4 +1,30 @@
-from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
+import functools
+import hashlib
+import operator
+import random
+
+from django.conf import settings
+from django.contrib.postgres.search import (
+    SearchQuery, SearchRank, TrigramSimilarity
+)
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.paginator import (
+    Paginator, Page, PageNotAnInteger, EmptyPage
+)
+from django.db import connection
+from django.db.models import CharField, F, Q
+from django.db.models.functions import Upper
+
+from . import similarity
+from .models import CatalogVersion, Favorite, Product, Suggestion
+
+# text search configuration of the products names
+SEARCH_CONFIG = "french"
+
+# lookups on UPPER(name), eg. name__upper__trigram_similar: the products
+# names are indexed upper cased (see migration 0006)
+CharField.register_lookup(Upper)
 
 
 def view_pagination(request, n_el, model_elem):
@@ -42,15 +68,285 @@ def page_indexing(elems, np_display):
 
 
 def select_better_product(chosen_product, products):
-    if chosen_product.nutri_grade == "a":
-        better_products = [
-            product for product in products
-            if product.nutri_grade == chosen_product.nutri_grade
-        ]
-    else:
-        better_products = [
-            product for product in products
-            if product.nutri_grade <= chosen_product.nutri_grade
-        ]
-
-    return better_products
+    """
+    Returns the queryset of the products with a grade better than or
+    equal to the one of the chosen product, best grades first.
+    Filtered and ordered by the database, so that a page of it is
+    fetched with LIMIT/OFFSET.
+    """
+    return products.filter(
+        nutri_grade__lte=chosen_product.nutri_grade
+    ).order_by("nutri_grade", "id")
+
+
+def product_substitutes(product):
+    """
+    Returns the queryset of the substitutes of a product computed by
+    db_feeding.py, best first: one lookup of the index of their ranks.
+    """
+    return Product.objects.filter(
+        substituted_set__product=product
+    ).order_by("substituted_set__rank")
+
+
+def mark_favorites(user, products):
+    """
+    Sets is_favorite on each of the products displayed to user, from
+    their favorites fetched with one query.
+    """
+    favorites = set(
+        Favorite.objects.filter(
+            user=user,
+            substitute__in=[product.id for product in products],
+        ).values_list("substitute_id", flat=True)
+    )
+
+    for product in products:
+        product.is_favorite = product.id in favorites
+
+
+def search_backend():
+    """
+    Returns the search backend set in settings.PRODUCTS_SEARCH_BACKEND
+    """
+    backend = settings.PRODUCTS_SEARCH_BACKEND
+
+    if backend not in ("fulltext", "trigram", "icontains"):
+        raise ImproperlyConfigured(
+            "Unknown PRODUCTS_SEARCH_BACKEND: {}".format(backend)
+        )
+
+    return backend
+
+
+def set_trigram_cutoff():
+    """
+    Sets the similarity above which names match a trigram search to
+    settings.PRODUCTS_TRIGRAM_CUTOFF, for the queries of the connection.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT set_config('pg_trgm.similarity_threshold', %s, false)",
+            [str(settings.PRODUCTS_TRIGRAM_CUTOFF)],
+        )
+
+
+def trigram_filter(word):
+    """
+    Returns the Q filter of the names containing word, or similar to it.
+    Both lookups are on UPPER(name), so both use its trigram index.
+    """
+    return Q(name__icontains=word) | Q(name__upper__trigram_similar=word)
+
+
+def search_products(query):
+    """
+    Returns the products whose name matches the query, best matches first.
+    fulltext: names with all the words of the query, ranked
+    trigram: names containing the query or similar to it, misspelled
+    queries included, the most similar first
+    icontains: names containing the query
+    """
+    backend = search_backend()
+
+    if backend == "fulltext":
+        search_query = SearchQuery(query, config=SEARCH_CONFIG)
+
+        return Product.objects.filter(
+            search_vector=search_query
+        ).annotate(
+            rank=SearchRank(F("search_vector"), search_query)
+        ).order_by("-rank", "id")
+
+    if backend == "trigram":
+        set_trigram_cutoff()
+
+        return Product.objects.filter(
+            trigram_filter(query)
+        ).annotate(
+            similarity=TrigramSimilarity("name", query)
+        ).order_by("-similarity", "id")
+
+    # title contains the query and query is not sensitive to case.
+    return Product.objects.filter(name__icontains=query)
+
+
+def any_word_filter(query):
+    """
+    Returns the Q filter of the products whose name matches any word of
+    the query, matching none without words.
+    """
+    words = query.split()
+    if not words:
+        return Q(pk__in=[])
+
+    # https://stackoverflow.com/questions/4824759/
+    # django-query-using-contains-each-value-in-a-list
+    # https://docs.python.org/2/library/operator.html
+    if search_backend() == "fulltext":
+        return Q(search_vector=functools.reduce(
+            operator.or_, (
+                SearchQuery(word, config=SEARCH_CONFIG) for word in words
+            )
+        ))
+
+    if search_backend() == "trigram":
+        return functools.reduce(
+            operator.or_, (trigram_filter(word) for word in words)
+        )
+
+    return functools.reduce(
+        operator.or_, (Q(name__icontains=item) for item in words)
+    )
+
+
+def better_products(chosen_product, query):
+    """
+    Returns the ids of the products better than the chosen one, best
+    first: its substitutes computed by db_feeding.py or, when it has none,
+    the products of its category matching any word of the query with a
+    better or equal grade, ranked by grade then by closeness of their
+    nutrients (see products.similarity), the first PRODUCTS_BETTER_COUNT
+    ones. Without any, the products of its category with a better grade
+    and the closest nutrients.
+    """
+    engine = similarity.engine(chosen_product.cat_id, catalog_generation())
+
+    ids = list(
+        product_substitutes(chosen_product).values_list("id", flat=True)
+    )
+    if ids:
+        return engine.rank(chosen_product.id, ids)
+
+    # products excluding the chosen product,
+    # with a better or equal grade by select_better_product
+    products = Product.objects.filter(
+        any_word_filter(query),
+        cat=chosen_product.cat,
+    ).exclude(
+        name=chosen_product.name
+    )
+    # all of them are ranked: the closest ones may be anywhere
+    ids = list(
+        select_better_product(chosen_product, products).values_list(
+            "id", flat=True
+        )
+    )
+    if not ids:
+        return engine.closest(
+            chosen_product.id, settings.PRODUCTS_BETTER_COUNT
+        )
+
+    return engine.rank(chosen_product.id, ids)[:settings.PRODUCTS_BETTER_COUNT]
+
+
+def suggestion_candidates():
+    """
+    Returns the queryset of the products which can be suggested: graded a,
+    with an image, and not fries.
+    """
+    return Product.objects.filter(
+        nutri_grade="a").exclude(
+            img__isnull=True).exclude(
+            name__icontains="frite").exclude(
+            name__icontains="frie")
+
+
+def suggested_products(count):
+    """
+    Returns count products drawn at random from the pool of suggestions
+    fed by db_feeding.py. The ids of the pool are cached until the catalog
+    is fed again. Without a pool, products are drawn among all the
+    candidates by the database.
+    """
+    key = "products.suggestions:{}".format(catalog_generation())
+    pool = cache.get(key)
+
+    if pool is None:
+        pool = list(Suggestion.objects.values_list("product_id", flat=True))
+        cache.set(key, pool, settings.PRODUCTS_SEARCH_CACHE_TIMEOUT)
+
+    if not pool:
+        return suggestion_candidates().order_by('?')[:count]
+
+    return list(Product.objects.prefetch_related("brands").in_bulk(
+        random.sample(pool, min(count, len(pool)))
+    ).values())
+
+
+def catalog_generation():
+    """
+    Returns the generation of the catalog, see CatalogVersion
+    """
+    return CatalogVersion.objects.values_list(
+        "generation", flat=True
+    ).first() or 0
+
+
+def search_cache_key(query, page):
+    """
+    Returns the cache key of a page of the search of query, in the current
+    catalog generation. Queries differing only by case or spaces share it.
+    """
+    normalized = " ".join(query.lower().split())
+
+    return "products.search:{}:{}:{}:{}".format(
+        catalog_generation(),
+        settings.PRODUCTS_SEARCH_BACKEND,
+        # keys of memcached are short, without spaces
+        hashlib.md5(normalized.encode("utf8")).hexdigest(),
+        page,
+    )
+
+
+def search_catalog(request, query, n_el):
+    """
+    Returns the catalog part of a search, as a dict: id of the chosen
+    product ("chosen", None when no product matches the query), ids of the
+    page of the request of its better products ("page"), number of the page
+    ("number") and count of all of them ("count").
+    Cached for settings.PRODUCTS_SEARCH_CACHE_TIMEOUT seconds, until the
+    catalog is fed again.
+    """
+    key = search_cache_key(query, request.GET.get('page'))
+    catalog = cache.get(key)
+
+    if catalog is None:
+        chosen_product = search_products(query).first()
+
+        if chosen_product:
+            products = view_pagination(
+                request, n_el, better_products(chosen_product, query)
+            )
+            catalog = {
+                "chosen": chosen_product.id,
+                "page": list(products),
+                "number": products.number,
+                "count": products.paginator.count,
+            }
+        else:
+            catalog = {"chosen": None}
+
+        cache.set(key, catalog, settings.PRODUCTS_SEARCH_CACHE_TIMEOUT)
+
+    return catalog
+
+
+def catalog_page(catalog, n_el):
+    """
+    Returns the chosen product and the page of its better products of a
+    catalog (see search_catalog), fetched with one query, and their brands
+    with another one.
+    """
+    products = Product.objects.prefetch_related("brands").in_bulk(
+        [catalog["chosen"]] + catalog["page"]
+    )
+
+    page = Page(
+        [products[id] for id in catalog["page"] if id in products],
+        catalog["number"],
+        # a page of count products, n_el per page
+        Paginator(range(catalog["count"]), n_el),
+    )
+
+    return products.get(catalog["chosen"]), page
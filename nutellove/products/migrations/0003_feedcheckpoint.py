@@ -0,0 +1,22 @@
+# Generated by Django 2.0.3 on 2026-10-18 15:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0002_remove_favorite_product'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(max_length=100, unique=True)),
+                ('source', models.CharField(max_length=100)),
+                ('offset', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
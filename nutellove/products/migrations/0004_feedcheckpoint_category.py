@@ -0,0 +1,27 @@
+# Generated by Django 2.0.3 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0003_feedcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feedcheckpoint',
+            name='category',
+            field=models.CharField(blank=True, max_length=500),
+        ),
+        migrations.AlterField(
+            model_name='feedcheckpoint',
+            name='stage',
+            field=models.CharField(max_length=100),
+        ),
+        migrations.AlterUniqueTogether(
+            name='feedcheckpoint',
+            unique_together={('stage', 'category')},
+        ),
+    ]
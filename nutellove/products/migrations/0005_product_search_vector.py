@@ -0,0 +1,45 @@
+# Generated by Django 2.0.3 on 2026-10-18 15:53
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0004_feedcheckpoint_category'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='products_pr_search__98d711_gin'),
+        ),
+        # keeps search_vector up to date whatever writes the products:
+        # the ORM, the upserts and the COPY of db_feeding.py
+        migrations.RunSQL(
+            sql=[
+                """
+                CREATE TRIGGER products_product_search_vector_update
+                BEFORE INSERT OR UPDATE OF name ON products_product
+                FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(
+                    search_vector, 'pg_catalog.french', name
+                )
+                """,
+                """
+                UPDATE products_product
+                SET search_vector = to_tsvector('pg_catalog.french', name)
+                """,
+            ],
+            reverse_sql="""
+                DROP TRIGGER products_product_search_vector_update
+                ON products_product
+            """,
+        ),
+    ]
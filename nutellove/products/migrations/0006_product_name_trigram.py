@@ -0,0 +1,26 @@
+# Generated by Django 2.0.3 on 2026-10-18 15:55
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0005_product_search_vector'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        # trigrams of the upper cased name: used by name__icontains
+        # (UPPER(name) LIKE UPPER(...)) as well as by the similarity
+        # operator of the trigram search.
+        # Written in SQL, GinIndex has no operator class in Django 2.0.
+        migrations.RunSQL(
+            sql="""
+                CREATE INDEX products_product_name_trgm
+                ON products_product USING gin (UPPER(name) gin_trgm_ops)
+            """,
+            reverse_sql="DROP INDEX products_product_name_trgm",
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.0.3 on 2026-10-18 16:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0006_product_name_trigram'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Substitute',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.IntegerField()),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='substitutes_set', to='products.Product')),
+                ('substitute', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='substituted_set', to='products.Product')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='substitute',
+            unique_together={('product', 'rank')},
+        ),
+    ]
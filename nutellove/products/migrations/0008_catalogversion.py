@@ -0,0 +1,29 @@
+# Generated by Django 2.0.3 on 2026-10-18 16:07
+
+from django.db import migrations, models
+
+
+def create_catalog_version(apps, schema_editor):
+    # the single row db_feeding.py increments
+    CatalogVersion = apps.get_model('products', 'CatalogVersion')
+    CatalogVersion.objects.create()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0007_substitute'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generation', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(
+            create_catalog_version, migrations.RunPython.noop
+        ),
+    ]
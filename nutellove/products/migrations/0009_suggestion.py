@@ -0,0 +1,21 @@
+# Generated by Django 2.0.3 on 2026-10-18 16:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0008_catalogversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Suggestion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='products.Product')),
+            ],
+        ),
+    ]
@@ -1,5 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 
 # Create your models here.
 
@@ -48,6 +50,12 @@ class Product(models.Model):
     last_modified_t = models.DateTimeField(null=False)
     brands = models.ManyToManyField(Brand, db_table="products_brands")
     stores = models.ManyToManyField(Store, db_table="products_stores")
+    # french full-text search vector of name, computed by a trigger
+    # on every insert or update of name (see migration 0005)
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [GinIndex(fields=["search_vector"])]
 
     def __str__(self):
         return self.name
@@ -66,3 +74,66 @@ class Favorite(models.Model):
         on_delete=models.CASCADE,
         default=0,
     )
+
+
+class Substitute(models.Model):
+    """
+    A product of the same category as another one, with a better or equal
+    grade and words of its name, ranked among its substitutes (1 is the
+    best).
+    Computed by db_feeding.py, see DBFeed.fill_substitutes.
+    """
+    product = models.ForeignKey(
+        Product,
+        related_name='substitutes_set',
+        on_delete=models.CASCADE,
+    )
+    substitute = models.ForeignKey(
+        Product,
+        related_name='substituted_set',
+        on_delete=models.CASCADE,
+    )
+    rank = models.IntegerField()
+
+    class Meta:
+        # also the index of the substitutes of a product, by rank
+        unique_together = ("product", "rank")
+
+
+class Suggestion(models.Model):
+    """
+    A product of the pool Search suggests when the query is empty, drawn
+    by db_feeding.py among the products that can be suggested.
+    """
+    product = models.OneToOneField(
+        Product,
+        on_delete=models.CASCADE,
+    )
+
+
+class CatalogVersion(models.Model):
+    """
+    Generation of the products catalog, incremented by db_feeding.py at the
+    end of each run: the searches cached for a generation are not read by
+    the next ones. A single row, created by its migration.
+    """
+    generation = models.IntegerField(default=0)
+
+
+class FeedCheckpoint(models.Model):
+    """
+    Progress of a stage of db_feeding.py: number of rows of the source
+    file committed by the stage, so that a stopped run can resume.
+    """
+    stage = models.CharField(max_length=100)
+    # category fed by a worker of a parallel run, empty otherwise
+    category = models.CharField(blank=True, max_length=500)
+    # size and modification time of the file being fed
+    source = models.CharField(max_length=100)
+    offset = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("stage", "category")
+
+    def __str__(self):
+        return "{} {} ({})".format(self.stage, self.category, self.offset)
@@ -0,0 +1,236 @@
+# coding: utf8
+
+import warnings
+
+import numpy as np
+
+try:
+    # optional: indexes the products of a category and grade with a kd-tree
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+from .models import Product
+
+# nutrients of 100g of a product, in the order of the vectors
+NUTRIENTS = ["energy", "fat", "carbs", "sugars", "fibers", "proteins", "salt"]
+
+# nutri_grade codes, best first. Products without a grade get the code
+# following these ones: no product is worse.
+GRADES = "abcde"
+
+
+# #####--- FUNCTIONS ----##### #
+def grade_codes(grades):
+    """
+    Returns the codes (0 for a, 4 for e, 5 without grade) of an array of
+    nutri_grade values.
+    """
+    codes = np.full(len(grades), len(GRADES), dtype=np.int8)
+    for code, grade in enumerate(GRADES):
+        codes[(grades == grade) | (grades == grade.upper())] = code
+    return codes
+
+
+def normalize(nutrients):
+    """
+    Returns the nutrients (one row per product) of a category centered and
+    scaled by nutrient, so that each nutrient weighs the same in the
+    distances. Missing values are replaced by the mean of the category.
+    """
+    with warnings.catch_warnings():
+        # nutrients missing from the whole category give nan and warn
+        warnings.simplefilter("ignore", RuntimeWarning)
+        mean = np.nanmean(nutrients, axis=0)
+        std = np.nanstd(nutrients, axis=0)
+
+    # nutrients missing from the whole category, or all equal
+    mean[np.isnan(mean)] = 0
+    std[np.isnan(std) | (std == 0)] = 1
+
+    vectors = (nutrients - mean) / std
+    vectors[np.isnan(vectors)] = 0
+    return vectors
+
+
+def engine(category_id, generation):
+    """
+    Returns the SimilarityEngine of the products of a category in the
+    catalog generation (see products.models.CatalogVersion), built from
+    the database the first time it is needed.
+    """
+    category_engine = _engines.get(category_id)
+
+    if category_engine is None or category_engine.generation != generation:
+        # threads needing it at once each build it, none waits for another
+        category_engine = SimilarityEngine.from_database(
+            category_id, generation
+        )
+        _engines[category_id] = category_engine
+
+    return category_engine
+
+
+def reset():
+    """
+    Forgets the engines built by this process.
+    """
+    _engines.clear()
+
+
+# #####--- CLASSES ----##### #
+class SimilarityEngine():
+    """
+    Nutrient profiles of products (eg. of a category), held in numpy arrays
+    sorted by id. Vectors are normalized by category, products being only
+    compared to the ones of their category.
+    """
+
+    def __init__(self, ids, categories, grades, nutrients, generation=None):
+        order = np.argsort(ids, kind="mergesort")
+        self.ids = np.asarray(ids, dtype=np.int64)[order]
+        self.categories = np.asarray(categories, dtype=np.int64)[order]
+        self.grades = grade_codes(np.asarray(grades, dtype=object)[order])
+        self.generation = generation
+
+        nutrients = np.asarray(nutrients, dtype=np.float64)[order]
+        self.vectors = np.zeros((len(self.ids), len(NUTRIENTS)))
+
+        # rows of the products of each category
+        self.category_rows = {}
+        for category in np.unique(self.categories):
+            rows = np.flatnonzero(self.categories == category)
+            self.category_rows[category] = rows
+            self.vectors[rows] = normalize(nutrients[rows])
+
+        # kd-trees by (category, grade code), built when first queried
+        self.trees = {}
+
+    @classmethod
+    def from_database(cls, category_id, generation=None):
+        """
+        Returns the engine of the products of a category, loaded with one
+        query.
+        """
+        rows = list(Product.objects.filter(cat_id=category_id).values_list(
+            "id", "cat_id", "nutri_grade", *NUTRIENTS
+        ))
+        if not rows:
+            return cls([], [], [], np.empty((0, len(NUTRIENTS))), generation)
+
+        columns = list(zip(*rows))
+        # missing nutrients (None) are nan
+        nutrients = np.array(columns[3:], dtype=np.float64).T
+
+        return cls(columns[0], columns[1], columns[2], nutrients, generation)
+
+    def rows(self, ids):
+        """
+        Returns the rows of the products of ids, -1 for the ones unknown to
+        the engine (eg. created after it was built).
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.ids):
+            return np.full(len(ids), -1, dtype=np.int64)
+
+        rows = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        rows[self.ids[rows] != ids] = -1
+        return rows
+
+    def distances(self, row, rows):
+        """
+        Returns the euclidean distances of the vector of a row to the
+        vectors of rows.
+        """
+        return np.sqrt(((self.vectors[rows] - self.vectors[row]) ** 2).sum(1))
+
+    def rank(self, product_id, ids):
+        """
+        Returns ids ordered by grade, then by distance to the nutrient
+        profile of a product. The ids unknown to the engine follow, in
+        their order, like all of them when the product is unknown.
+        """
+        row = self.rows([product_id])[0]
+        if row < 0:
+            return list(ids)
+
+        ids = np.asarray(ids, dtype=np.int64)
+        rows = self.rows(ids)
+        known = rows >= 0
+
+        order = np.lexsort((
+            ids[known],
+            self.distances(row, rows[known]),
+            self.grades[rows[known]],
+        ))
+        return ids[known][order].tolist() + ids[~known].tolist()
+
+    def better_rows(self, row):
+        """
+        Returns the rows of the products of the category of a row with a
+        strictly better grade, or the other products graded a for a product
+        graded a.
+        """
+        rows = self.category_rows[self.categories[row]]
+        grade = self.grades[row]
+
+        if grade == 0:
+            return rows[(self.grades[rows] == 0) & (rows != row)]
+        return rows[self.grades[rows] < grade]
+
+    def tree(self, category, grade):
+        """
+        Returns the kd-tree and the rows of the products of a category and
+        grade code.
+        """
+        key = (category, grade)
+        if key not in self.trees:
+            rows = self.category_rows[category]
+            rows = rows[self.grades[rows] == grade]
+            self.trees[key] = (cKDTree(self.vectors[rows]), rows)
+        return self.trees[key]
+
+    def closest(self, product_id, count):
+        """
+        Returns the ids of the count products of the category of a product
+        with a strictly better grade (see better_rows) whose nutrient
+        profile is the closest to its one, closest first.
+        With scipy, the nearest products of each better grade are queried
+        from kd-trees, otherwise the distances to all of them are computed.
+        """
+        row = self.rows([product_id])[0]
+        if row < 0:
+            return []
+
+        if cKDTree is None:
+            rows = self.better_rows(row)
+            distances = self.distances(row, rows)
+            if len(rows) > count:
+                nearest = np.argpartition(distances, count)[:count]
+                rows, distances = rows[nearest], distances[nearest]
+        else:
+            category, grade = self.categories[row], self.grades[row]
+            found_rows, found_distances = [], []
+
+            for better_grade in range(max(grade, 1)):
+                tree, grade_rows = self.tree(category, better_grade)
+                # one more for a product graded a, found itself
+                k = min(count + 1, len(grade_rows))
+                if not k:
+                    continue
+
+                distances, indexes = tree.query(self.vectors[row], k=k)
+                found_rows.append(grade_rows[np.atleast_1d(indexes)])
+                found_distances.append(np.atleast_1d(distances))
+
+            rows = np.concatenate(found_rows or [np.empty(0, np.int64)])
+            distances = np.concatenate(found_distances or [np.empty(0)])
+            distances = distances[rows != row]
+            rows = rows[rows != row]
+
+        order = np.lexsort((self.ids[rows], distances))[:count]
+        return self.ids[rows[order]].tolist()
+
+
+# engines of the categories used by this process, by category id
+_engines = {}
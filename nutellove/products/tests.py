@@ -1,12 +1,41 @@
 import datetime
 import json
 
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.utils import timezone
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.contrib.auth.models import User
 from django.contrib import auth
-from .models import Product, Category, Brand, Store, Favorite
+from django.db.models import F
+from .models import (
+    Product, Category, Brand, Store, Favorite, Substitute, CatalogVersion,
+    Suggestion,
+)
+from .controllers import (
+    any_word_filter, better_products, mark_favorites, product_substitutes,
+    search_products, select_better_product,
+)
+from . import similarity
+from .similarity import SimilarityEngine
+
+
+def create_product(code, name, grade, category, **fields):
+    """
+    Creates a product of a category, with an url made of its code
+    """
+    return Product.objects.create(
+        code=code,
+        url="http://world-fr.openfoodfacts.org/produit/{}".format(code),
+        name=name,
+        nutri_grade=grade,
+        cat=category,
+        last_modified_t=timezone.make_aware(
+            datetime.datetime.fromtimestamp(1498134406)
+        ),
+        **fields
+    )
 
 
 class DetailPageTestCase(TestCase):
@@ -56,6 +85,9 @@ class SearchProductPageTestCase(TestCase):
     # test that detail page returns a 200 if the item exists.
 
     def setUp(self):
+        # results cached by the other tests
+        cache.clear()
+
         # create a category
         biscuit_category = Category.objects.create(name="Biscuits")
         soupe_category = Category.objects.create(name="Soupes")
@@ -162,6 +194,435 @@ class SearchProductPageTestCase(TestCase):
         self.assertIn(b'Suggestion de produits', response.content)
 
 
+class SelectBetterProductTestCase(TestCase):
+    """
+    Testing the selection of the products better than the chosen one
+    """
+
+    def setUp(self):
+        biscuit_category = Category.objects.create(name="Biscuits")
+
+        for code, grade in enumerate("ecbdab"):
+            create_product(
+                code, "Biscuit {}".format(code), grade, biscuit_category
+            )
+
+    def test_better_or_equal_grades_first(self):
+        """
+        Test that the products are the ones with a better or equal grade,
+        the best first
+        """
+        chosen_product = Product.objects.get(code=1)
+        better_products = select_better_product(
+            chosen_product, Product.objects.exclude(pk=chosen_product.pk)
+        )
+
+        self.assertEqual(
+            [(product.code, product.nutri_grade)
+             for product in better_products],
+            [(4, "a"), (2, "b"), (5, "b")],
+        )
+
+    def test_best_grade(self):
+        """
+        Test that only the products graded a are better than a product
+        graded a
+        """
+        chosen_product = Product.objects.get(code=4)
+
+        self.assertEqual(
+            list(select_better_product(chosen_product, Product.objects.all())),
+            [chosen_product],
+        )
+
+
+class SubstitutesTestCase(TestCase):
+    """
+    Testing the search of the substitutes computed by db_feeding.py
+    """
+
+    def setUp(self):
+        cache.clear()
+
+        biscuit_category = Category.objects.create(name="Biscuits")
+
+        self.products = [
+            create_product(code, name, grade, biscuit_category)
+            for code, (name, grade) in enumerate([
+                ("Biscuit au chocolat", "e"),
+                ("Sablé nature", "a"),
+                ("Biscuit aux céréales", "b"),
+                ("Biscuit fourré", "c"),
+            ])
+        ]
+
+        chosen_product, sable, cereales, fourre = self.products
+        Substitute.objects.create(
+            product=chosen_product, substitute=cereales, rank=1
+        )
+        Substitute.objects.create(
+            product=chosen_product, substitute=sable, rank=2
+        )
+
+    def test_substitutes_by_rank(self):
+        """
+        Test that the substitutes of a product are the ones computed,
+        ordered by rank
+        """
+        chosen_product, sable, cereales, fourre = self.products
+
+        self.assertEqual(
+            list(product_substitutes(chosen_product)), [cereales, sable]
+        )
+
+    def test_search_displays_substitutes(self):
+        """
+        Test that the search displays the substitutes computed rather than
+        the products matching the query
+        """
+        response = self.client.get(
+            reverse('products:search'), {"query": "Biscuit au chocolat"}
+        )
+
+        self.assertIn('Sablé nature'.encode('utf8'), response.content)
+        self.assertNotIn('Biscuit fourré'.encode('utf8'), response.content)
+
+    def test_search_without_substitutes(self):
+        """
+        Test that the products matching the query are displayed when no
+        substitutes were computed
+        """
+        Substitute.objects.all().delete()
+
+        response = self.client.get(
+            reverse('products:search'), {"query": "Biscuit au chocolat"}
+        )
+
+        self.assertIn('Biscuit fourré'.encode('utf8'), response.content)
+        self.assertNotIn('Sablé nature'.encode('utf8'), response.content)
+
+
+class SearchCacheTestCase(TestCase):
+    """
+    Testing the cache of the search results
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.biscuit_category = Category.objects.create(name="Biscuits")
+
+        create_product("0", "Gâteau au chocolat", "e", self.biscuit_category)
+        create_product("1", "Biscuit au chocolat", "b", self.biscuit_category)
+
+    def search(self, query):
+        return self.client.get(reverse('products:search'), {"query": query})
+
+    def test_search_is_cached(self):
+        """
+        Test that the products of a query searched again are the cached
+        ones, whatever the case and spaces of the query
+        """
+        self.search("gâteau au chocolat")
+        create_product("2", "Sablé au chocolat", "a", self.biscuit_category)
+
+        response = self.search("  Gâteau  au Chocolat")
+
+        self.assertIn(b'Biscuit au chocolat', response.content)
+        self.assertNotIn('Sablé'.encode('utf8'), response.content)
+
+    def test_new_generation_is_not_cached(self):
+        """
+        Test that the results cached are not read once the catalog
+        generation changed
+        """
+        self.search("gâteau au chocolat")
+        create_product("2", "Sablé au chocolat", "a", self.biscuit_category)
+        CatalogVersion.objects.update(generation=F("generation") + 1)
+
+        response = self.search("gâteau au chocolat")
+
+        self.assertIn('Sablé au chocolat'.encode('utf8'), response.content)
+
+
+class SuggestionsTestCase(TestCase):
+    """
+    Testing the products suggested when the query is empty
+    """
+
+    def setUp(self):
+        cache.clear()
+        soupe_category = Category.objects.create(name="Soupes")
+
+        self.soupes = [
+            create_product(
+                code, name, "a", soupe_category,
+                img="https://static.openfoodfacts.org/images/{}.jpg".format(
+                    code
+                ),
+            )
+            for code, name in enumerate(["Soupe de potiron", "Soupe miso"])
+        ]
+
+    def test_suggestions_from_pool(self):
+        """
+        Test that the products suggested are the ones of the pool
+        """
+        Suggestion.objects.create(product=self.soupes[1])
+
+        response = self.client.get(reverse('products:search'))
+
+        self.assertIn(b'Soupe miso', response.content)
+        self.assertNotIn(b'Soupe de potiron', response.content)
+
+    def test_suggestions_without_pool(self):
+        """
+        Test that the products suggested are drawn among the candidates
+        when the pool is not fed
+        """
+        response = self.client.get(reverse('products:search'))
+
+        self.assertIn(b'Soupe miso', response.content)
+        self.assertIn(b'Soupe de potiron', response.content)
+
+
+class SearchBackendTestCase(TestCase):
+    """
+    Testing the search backends of settings.PRODUCTS_SEARCH_BACKEND
+    """
+
+    def setUp(self):
+        biscuit_category = Category.objects.create(name="Biscuits")
+
+        self.biscuit = Product.objects.create(
+            code="454588",
+            url="http://world-fr.openfoodfacts.org/produit/00454588/gateau",
+            name="Gâteau au chocolat",
+            nutri_grade="b",
+            cat=biscuit_category,
+            last_modified_t=timezone.make_aware(
+                datetime.datetime.fromtimestamp(1498134406)
+            ),
+        )
+
+    @override_settings(PRODUCTS_SEARCH_BACKEND="fulltext")
+    def test_fulltext_matches_words_forms(self):
+        """
+        Test that the full-text search matches the other forms of a word
+        """
+        self.assertEqual(list(search_products("chocolats")), [self.biscuit])
+
+    @override_settings(PRODUCTS_SEARCH_BACKEND="fulltext")
+    def test_fulltext_follows_name_updates(self):
+        """
+        Test that the search vector is updated with the name
+        """
+        self.biscuit.name = "Biscuit nature"
+        self.biscuit.save()
+
+        self.assertEqual(list(search_products("chocolat")), [])
+        self.assertEqual(list(search_products("nature")), [self.biscuit])
+
+    @override_settings(PRODUCTS_SEARCH_BACKEND="trigram")
+    def test_trigram_matches_misspellings(self):
+        """
+        Test that the trigram search matches misspelled names first,
+        then the names containing the query
+        """
+        nutella = Product.objects.create(
+            code="3017620429484",
+            url="http://world-fr.openfoodfacts.org/produit/3017620429484/nutella",
+            name="Nutella",
+            nutri_grade="e",
+            cat=self.biscuit.cat,
+            last_modified_t=timezone.make_aware(
+                datetime.datetime.fromtimestamp(1498134406)
+            ),
+        )
+
+        self.assertEqual(list(search_products("nutela")), [nutella])
+        self.assertEqual(list(search_products("au choc")), [self.biscuit])
+
+    @override_settings(
+        PRODUCTS_SEARCH_BACKEND="trigram", PRODUCTS_TRIGRAM_CUTOFF=0.9
+    )
+    def test_trigram_cutoff(self):
+        """
+        Test that names less similar than the cutoff are not matched
+        """
+        self.assertEqual(list(search_products("gateau au chocolt")), [])
+
+    @override_settings(PRODUCTS_SEARCH_BACKEND="icontains")
+    def test_icontains_matches_substrings(self):
+        """
+        Test that the icontains search only matches parts of names
+        """
+        self.assertEqual(list(search_products("au choc")), [self.biscuit])
+        self.assertEqual(list(search_products("chocolats")), [])
+
+    @override_settings(PRODUCTS_SEARCH_BACKEND="unknown")
+    def test_unknown_backend(self):
+        """
+        Test that an unknown backend is refused
+        """
+        with self.assertRaises(ImproperlyConfigured):
+            search_products("chocolat")
+
+    def test_blank_query(self):
+        """
+        Test that a query of spaces matches no product, and that the search
+        suggests products instead
+        """
+        for backend in ["fulltext", "trigram", "icontains"]:
+            with self.settings(PRODUCTS_SEARCH_BACKEND=backend):
+                self.assertEqual(
+                    list(Product.objects.filter(any_word_filter("  "))), []
+                )
+
+                response = self.client.get(
+                    reverse('products:search'), {"query": " "}
+                )
+                self.assertEqual(response.status_code, 200)
+                self.assertIsNone(response.context["chosen_product"])
+
+
+class SimilarityTestCase(TestCase):
+    """
+    Testing the ranking of the better products by their nutrients
+    """
+
+    def setUp(self):
+        cache.clear()
+        # generations are rolled back between tests: forget the engines of
+        # the products of the other ones
+        similarity.reset()
+
+        self.biscuit_category = Category.objects.create(name="Biscuits")
+
+        self.engine = SimilarityEngine(
+            ids=[1, 2, 3, 4, 5],
+            categories=[1, 1, 1, 1, 2],
+            grades=["e", "b", "b", "a", "a"],
+            nutrients=[
+                [100, 20, None, 5, 1, 2, 0.5],
+                [110, 20, None, 5, 1, 2, 0.5],
+                [400, 20, None, 5, 1, 2, 0.5],
+                [200, 20, None, 5, 1, 2, 0.5],
+                [100, 20, None, 5, 1, 2, 0.5],
+            ],
+        )
+
+    def test_rank_by_grade_then_nutrients(self):
+        """
+        Test that products are ranked by grade, then by closeness of their
+        nutrients, the unknown ones last
+        """
+        self.assertEqual(self.engine.rank(1, [99, 3, 2, 4]), [4, 2, 3, 99])
+
+    def test_closest_better_products(self):
+        """
+        Test that the closest products are the ones of the category with a
+        better grade, closest nutrients first
+        """
+        self.assertEqual(self.engine.closest(1, 2), [2, 4])
+        self.assertEqual(self.engine.closest(2, 5), [4])
+        self.assertEqual(self.engine.closest(4, 5), [])
+        self.assertEqual(self.engine.closest(99, 5), [])
+
+    def test_search_displays_closest_products(self):
+        """
+        Test that the search displays the products with a better grade and
+        the closest nutrients when none matches the query
+        """
+        create_product(
+            "0", "Biscuit au chocolat", "e", self.biscuit_category, energy=500
+        )
+        create_product(
+            "1", "Galette bretonne", "b", self.biscuit_category, energy=100
+        )
+        create_product(
+            "2", "Sablé nature", "a", self.biscuit_category, energy=480
+        )
+        create_product(
+            "3", "Cookie géant", "e", self.biscuit_category, energy=500
+        )
+
+        response = self.client.get(
+            reverse('products:search'), {"query": "Biscuit au chocolat"}
+        )
+        content = response.content.decode('utf8')
+
+        self.assertLess(
+            content.index('Sablé nature'), content.index('Galette bretonne')
+        )
+        self.assertNotIn('Cookie géant', content)
+
+    @override_settings(PRODUCTS_BETTER_COUNT=2)
+    def test_better_products_count(self):
+        """
+        Test that only the best graded products matching the query are
+        displayed
+        """
+        chosen_product = create_product(
+            "0", "Biscuit au chocolat", "e", self.biscuit_category
+        )
+        better = [
+            create_product(
+                code, "Sablé au chocolat {}".format(code), grade,
+                self.biscuit_category,
+            )
+            for code, grade in [("1", "c"), ("2", "a"), ("3", "b")]
+        ]
+
+        self.assertEqual(
+            better_products(chosen_product, "chocolat"),
+            [better[1].id, better[2].id],
+        )
+
+    @override_settings(PRODUCTS_BETTER_COUNT=2)
+    def test_better_products_closest_of_all(self):
+        """
+        Test that the products displayed are the closest of all the ones
+        matching the query, not of the first ones
+        """
+        chosen_product = create_product(
+            "0", "Biscuit au chocolat", "e", self.biscuit_category,
+            energy=500,
+        )
+        better = [
+            create_product(
+                code, "Sablé au chocolat {}".format(code), "a",
+                self.biscuit_category, energy=energy,
+            )
+            for code, energy in [("1", 100), ("2", 200), ("3", 490),
+                                 ("4", 520)]
+        ]
+
+        self.assertEqual(
+            better_products(chosen_product, "chocolat"),
+            [better[2].id, better[3].id],
+        )
+
+    def test_engine_of_a_category(self):
+        """
+        Test that the engine of a category only holds its products, and is
+        built again for another catalog generation
+        """
+        biscuit = create_product(
+            "0", "Biscuit au chocolat", "e", self.biscuit_category
+        )
+        create_product(
+            "1", "Soupe miso", "a", Category.objects.create(name="Soupes")
+        )
+
+        engine = similarity.engine(self.biscuit_category.id, 0)
+
+        self.assertEqual(engine.ids.tolist(), [biscuit.id])
+        self.assertIs(similarity.engine(self.biscuit_category.id, 0), engine)
+        self.assertIsNot(
+            similarity.engine(self.biscuit_category.id, 1), engine
+        )
+
+
 # Favorite page
 
 class FavoritesTestCase(TestCase):
@@ -266,3 +727,29 @@ class FavoritesTestCase(TestCase):
         # test that the Soupe Nulle product is displayed in the favorites,
         # as it was set up in the setUp() method.
         self.assertIn(b'Soupe nulle', response.content)
+
+    def test_mark_favorites(self):
+        """
+        Test that the favorites of the user are marked, with one query
+        """
+        products = [self.biscuit_product, self.soupe_product]
+
+        with self.assertNumQueries(1):
+            mark_favorites(self.user, products)
+
+        self.assertFalse(self.biscuit_product.is_favorite)
+        self.assertTrue(self.soupe_product.is_favorite)
+
+    def test_category_page_marks_favorites(self):
+        """
+        Test that the favorites of the user are marked on the page of a
+        category
+        """
+        response = self.client.get(
+            reverse(
+                'products:category_detail',
+                args=(self.soupe_product.cat.id,),
+            )
+        )
+
+        self.assertIn(b'Retirer des favoris', response.content)
@@ -1,15 +1,11 @@
-import functools
-import operator
-
 from django.contrib import auth
 from django.http import HttpResponse, HttpResponseRedirect
 from django.urls import reverse
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.shortcuts import render, get_object_or_404, redirect
-from .models import Brand, Category, Product, Favorite
+from .models import Brand, Category, Product
 from django.utils.translation import gettext
 from django.views import View
-from django.db.models import Q
 
 from .controllers import *
 
@@ -103,13 +99,7 @@ class BrandCategoryDetail(View):  # pragma: no cover
 
             # check if user is not anonymous
             if user.username != "":
-                for product in products:
-                    if Favorite.objects.filter(
-                        substitute=product, user=user
-                    ).exists():
-                        product.is_favorite = True
-                    else:
-                        product.is_favorite = False
+                mark_favorites(user, products)
 
             context = {
                 'obj': obj,
@@ -135,19 +125,15 @@ class Search(View):
         """
         Used to handle queries from user and perform a search
         """
-        query = request.GET.get('query')
+        # a query of spaces is no query
+        query = request.GET.get('query', '').strip()
 
         user = auth.get_user(request)
 
         if not query:
 
             # display random products with imgs
-            products = (Product.objects.filter(
-                nutri_grade="a").exclude(
-                    img__isnull=True).exclude(
-                    name__icontains="frite").exclude(
-                    name__icontains="frie").order_by('?')
-            )[:9]
+            products = suggested_products(9)
 
             title = gettext("Suggestion de produits")
 
@@ -155,59 +141,23 @@ class Search(View):
             page_range = None
 
         else:
-            # title contains the query and query is not sensitive to case.
-            products = Product.objects.filter(name__icontains=query)
-
-            # split the query in multiple parts (list)
-            q = query.split(" ")
-
-            if products:
-                chosen_product = products[0]
-
-                # https://stackoverflow.com/questions/4824759/
-                # django-query-using-contains-each-value-in-a-list
-                # https://docs.python.org/2/library/operator.html
-                new_query = functools.reduce(
-                    operator.or_, (
-                        Q(
-                            name__icontains=item
-                        ) for item in q)
-                )
-
-                # returns a list of products excluding the chosen product
-                # order products by nutri_grade,
-                # after a product has been chosen
-                products = Product.objects.filter(
-                    new_query,
-                    cat=chosen_product.cat,
-                ).exclude(
-                    name=chosen_product.name
-                ).order_by(
-                    "nutri_grade"
-                )
-
-                better_products = select_better_product(
-                    chosen_product, products
-                )
-
-                products = view_pagination(request, 6, better_products)
+            # chosen product and page of its better products, cached
+            catalog = search_catalog(request, query, 6)
+
+            if catalog["chosen"]:
+                chosen_product, products = catalog_page(catalog, 6)
                 page_range = page_indexing(products, 6)
 
             else:
                 chosen_product = None
+                products = []
                 page_range = None
 
             title = ""
 
         # check if user is not anonymous
         if user.username != "":  # pragma: no cover
-            for product in products:
-                if Favorite.objects.filter(
-                    substitute=product, user=user
-                ).exists():
-                    product.is_favorite = True
-                else:
-                    product.is_favorite = False
+            mark_favorites(user, products)
 
         context = {
             'chosen_product': chosen_product,
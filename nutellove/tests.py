@@ -0,0 +1,822 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+
+from constants import HEADERS_LIST
+from csv_cleaner import CSVCleaner, clean_piece, commit_state, split_file
+from dataset import (
+    CacheWriter, Dataset, is_delta, read_cache, read_dataset, split_names,
+    write_cache,
+)
+import db_feeding
+from db_feeding import DBFeed
+from products.models import (
+    Brand, Category, Favorite, Product, Store, Substitute,
+)
+
+# Tests of the scripts cleaning the csv and feeding the database: the
+# SimpleTestCase ones need no database.
+
+
+def off_product(code, **fields):
+    """
+    Returns a row of the Open Food Facts csv, as a dict
+    """
+    product = {
+        "creator": "openfoodfacts-contributors",
+        "code": code,
+        "url": "http://world-fr.openfoodfacts.org/produit/{}".format(code),
+        "product_name": "Biscuit {}".format(code),
+        "brands": "Lu",
+        "stores": "Carrefour",
+        "nutrition_grade_fr": "b",
+        "main_category_fr": "Biscuits",
+        "countries_fr": "France",
+        "energy_100g": 1800,
+        "fat_100g": 20.5,
+        "carbohydrates_100g": 60.0,
+        "sugars_100g": 30.0,
+        "fiber_100g": 2.5,
+        "proteins_100g": 6.0,
+        "salt_100g": 0.5,
+        "image_url": None,
+        "image_small_url": None,
+        "last_modified_t": 1498134406 + code,
+    }
+    product.update(fields)
+    return product
+
+
+def write_off_csv(fname, products):
+    """
+    Writes rows of the Open Food Facts csv (see off_product) to a tab
+    separated file, with a column which is not in HEADERS_LIST
+    """
+    pd.DataFrame(
+        products, columns=["creator"] + HEADERS_LIST
+    ).to_csv(fname, sep="\t", index=False, encoding="utf-8")
+
+
+class WorkDirMixin():
+    """
+    Runs each test in a temporary directory, where the Open Food Facts
+    csv is products.csv
+    """
+    # categories kept by the cleaning
+    categories = ["Biscuits"]
+
+    def setUp(self):
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+
+        old_dir = os.getcwd()
+        os.chdir(tmp_dir.name)
+        self.addCleanup(os.chdir, old_dir)
+
+        self.fname = os.path.abspath("products.csv")
+
+    def clean(self, **options):
+        """
+        Cleans the csv, keeping the products of categories sold in France
+        """
+        with contextlib.redirect_stdout(io.StringIO()):
+            CSVCleaner(self.fname).csv_cleaner(
+                HEADERS_LIST, self.categories, ["France"], **options
+            )
+
+
+class CleanerTestCase(WorkDirMixin, SimpleTestCase):
+    """
+    Runs each test in a temporary directory, holding an Open Food Facts
+    csv of 20 products, one of them of a category which is not kept
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.products = [off_product(code) for code in range(1, 21)]
+        self.products[4]["main_category_fr"] = "Soupes"
+        write_off_csv(self.fname, self.products)
+
+
+class FeedTestCase(WorkDirMixin, TestCase):
+    """
+    Feeds the database with Open Food Facts products, from a temporary
+    directory
+    """
+    categories = ["Biscuits", "Soupes"]
+
+    def feed(self, products, incremental=False, **options):
+        """
+        Cleans the products, then feeds them with db_feeding.main, which
+        takes options
+        """
+        write_off_csv(self.fname, products)
+        self.clean(chunksize=7, incremental=incremental)
+        with self.quiet():
+            db_feeding.main(**options)
+
+    def quiet(self):
+        """
+        Returns a context hiding the progress of a feeding
+        """
+        stack = contextlib.ExitStack()
+        stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        stack.enter_context(contextlib.redirect_stderr(io.StringIO()))
+        return stack
+
+    def urls(self):
+        """
+        Returns the urls of the products in the database, sorted
+        """
+        return sorted(Product.objects.values_list("url", flat=True))
+
+    def names(self, code, field):
+        """
+        Returns the names of the brands or stores (field) of the product of
+        code, sorted
+        """
+        product = Product.objects.get(url=off_product(code)["url"])
+        return sorted(getattr(product, field).values_list("name", flat=True))
+
+
+class SplitFileTestCase(CleanerTestCase):
+    """
+    Testing the pieces of the csv cleaned in parallel
+    """
+
+    def test_pieces_on_lines_boundaries(self):
+        """
+        Test that the pieces follow each other from the end of the header
+        line to the end of the file, each ending with a line
+        """
+        columns, pieces = split_file(self.fname, 300)
+
+        with open(self.fname, "rb") as f:
+            header = f.readline()
+            data = header + f.read()
+
+        self.assertEqual(columns, ["creator"] + HEADERS_LIST)
+        self.assertGreater(len(pieces), 1)
+        self.assertEqual(pieces[0][0], len(header))
+        self.assertEqual(pieces[-1][1], len(data))
+        for (start, end), (next_start, next_end) in zip(pieces, pieces[1:]):
+            self.assertEqual(end, next_start)
+        for start, end in pieces:
+            self.assertTrue(data[start:end].endswith(b"\n"))
+
+    def test_pieces_smaller_than_a_line(self):
+        """
+        Test that pieces hold one line at least, none being empty
+        """
+        columns, pieces = split_file(self.fname, 1)
+
+        self.assertEqual(len(pieces), len(self.products))
+
+    def test_clean_pieces(self):
+        """
+        Test that the cleaned pieces hold the kept rows of the file
+        """
+        columns, pieces = split_file(self.fname, 300)
+
+        codes = []
+        for start, end in pieces:
+            df = clean_piece((
+                self.fname, start, end, columns, HEADERS_LIST,
+                ["Biscuits"], ["France"],
+            ))
+            self.assertEqual(list(df.columns), HEADERS_LIST)
+            codes.extend(df["code"].tolist())
+
+        self.assertEqual(codes, [code for code in range(1, 21) if code != 5])
+
+    def test_pieces_merged_in_file_order(self):
+        """
+        Test that the pieces cleaned in parallel are written in the order
+        of the file, as the file cleaned by chunks
+        """
+        self.clean(workers=3, piece_size=300)
+        with open("db_file.csv") as f:
+            parallel = f.read()
+
+        self.clean(chunksize=7)
+        with open("db_file.csv") as f:
+            chunked = f.read()
+
+        self.assertEqual(parallel, chunked)
+        self.assertEqual(
+            pd.read_csv("db_file.csv", sep=";")["code"].tolist(),
+            [code for code in range(1, 21) if code != 5],
+        )
+
+
+class CacheTestCase(CleanerTestCase):
+    """
+    Testing the columnar cache of the cleaned csv
+    """
+
+    def part(self, codes, grades, names, energies):
+        return pd.DataFrame({
+            "code": np.array(codes, dtype="int64"),
+            "nutrition_grade_fr": pd.Categorical(grades),
+            "product_name": pd.Series(names, dtype=object),
+            "energy_100g": np.array(energies, dtype="float32"),
+        }, columns=["code", "nutrition_grade_fr", "product_name",
+                    "energy_100g"])
+
+    def test_round_trip(self):
+        """
+        Test that the dataframes appended to the cache are read back with
+        their dtypes, categories and missing values
+        """
+        open("db_file.csv", "w").close()
+        writer = CacheWriter("db_file.csv", [
+            "code", "nutrition_grade_fr", "product_name", "energy_100g",
+        ])
+        writer.append(self.part(
+            [1, 2, 3], ["b", None, "a"], ["Sablé", None, "Sablé"],
+            [1800.5, np.nan, 28.7],
+        ))
+        writer.append(self.part([4, 5], ["c", "a"], ["Cookie", None], [0, 1]))
+        writer.close()
+
+        df = read_cache("db_file.csv")
+
+        self.assertEqual(df["code"].dtype, np.int64)
+        self.assertEqual(df["code"].tolist(), [1, 2, 3, 4, 5])
+        self.assertEqual(df["energy_100g"].dtype, np.float32)
+        np.testing.assert_array_equal(
+            df["energy_100g"].values,
+            np.array([1800.5, np.nan, 28.7, 0, 1], dtype="float32"),
+        )
+        self.assertTrue(
+            pd.api.types.is_categorical_dtype(df["nutrition_grade_fr"])
+        )
+        self.assertEqual(
+            df["nutrition_grade_fr"].astype(object).fillna("").tolist(),
+            ["b", "", "a", "c", "a"],
+        )
+        self.assertEqual(
+            sorted(df["nutrition_grade_fr"].cat.categories), ["a", "b", "c"]
+        )
+        # missing strings are NaN, not "nan"
+        self.assertEqual(
+            df["product_name"].isnull().tolist(),
+            [False, True, False, False, True],
+        )
+        self.assertEqual(
+            df["product_name"].fillna("").tolist(),
+            ["Sablé", "", "Sablé", "Cookie", ""],
+        )
+
+    def test_empty_cache(self):
+        """
+        Test that a cache without rows has the columns of the csv
+        """
+        open("db_file.csv", "w").close()
+        write_cache(pd.DataFrame(columns=["code", "url"]), "db_file.csv")
+
+        df = read_cache("db_file.csv")
+
+        self.assertEqual(list(df.columns), ["code", "url"])
+        self.assertEqual(len(df), 0)
+
+    def test_stale_cache(self):
+        """
+        Test that the cache is not read once the csv changed, or without
+        the csv
+        """
+        with open("db_file.csv", "w") as f:
+            f.write("code\n1\n")
+        write_cache(self.part([1], ["a"], ["Sablé"], [1]), "db_file.csv")
+
+        with open("db_file.csv", "a") as f:
+            f.write("2\n")
+        self.assertIsNone(read_cache("db_file.csv"))
+
+        os.remove("db_file.csv")
+        self.assertIsNone(read_cache("db_file.csv"))
+
+    def test_cleaned_csv_cache(self):
+        """
+        Test that the cache written by the cleaning holds the cleaned csv
+        """
+        self.clean(chunksize=7)
+
+        cached = read_cache("db_file.csv")
+        os.remove(os.path.join("db_file_cache", "meta.json"))
+        parsed = read_dataset("db_file.csv")
+
+        self.assertEqual(list(cached.columns), HEADERS_LIST)
+        self.assertEqual(len(cached), 19)
+        for col in HEADERS_LIST:
+            pd.testing.assert_series_equal(
+                cached[col].astype(object), parsed[col].astype(object)
+            )
+
+
+class IncrementalCleaningTestCase(CleanerTestCase):
+    """
+    Testing the delta kept by an incremental cleaning, and its state
+    """
+
+    def cleaned_codes(self):
+        return pd.read_csv("db_file.csv", sep=";")["code"].tolist()
+
+    def test_select_delta(self):
+        """
+        Test that the rows kept are the ones whose code was never seen, or
+        modified after the high-water mark
+        """
+        with open("cleaner_state.json", "w") as f:
+            json.dump({"last_modified_t": 1000, "codes": [1, 2]}, f)
+
+        cleaner = CSVCleaner(self.fname)
+        cleaner.load_state()
+        df = pd.DataFrame({
+            "code": [1, 2, 3],
+            "last_modified_t": [900, 1100, 800],
+        })
+
+        self.assertEqual(
+            cleaner.select_delta(df, incremental=True)["code"].tolist(),
+            [2, 3],
+        )
+        self.assertEqual(len(cleaner.select_delta(df)), 3)
+        self.assertEqual(cleaner.new_last_modified_t, 1100)
+        self.assertEqual(cleaner.new_codes, {1, 2, 3})
+
+    def test_first_cleaning_keeps_all_rows(self):
+        """
+        Test that an incremental cleaning without state keeps all the rows
+        """
+        self.clean(chunksize=7, incremental=True)
+
+        self.assertEqual(len(self.cleaned_codes()), 19)
+
+    def test_state_saved_once_fed(self):
+        """
+        Test that the state of a cleaning is only read by the next ones
+        once the cleaned csv is fed
+        """
+        self.clean(chunksize=7)
+        self.assertFalse(os.path.exists("cleaner_state.json"))
+
+        commit_state("db_file.csv")
+
+        with open("cleaner_state.json") as f:
+            state = json.load(f)
+        self.assertEqual(state["last_modified_t"], 1498134406 + 20)
+        self.assertEqual(
+            state["codes"], [code for code in range(1, 21) if code != 5]
+        )
+        self.assertFalse(os.path.exists("cleaner_state.json.pending"))
+
+    def test_delta_cleaned_again_until_fed(self):
+        """
+        Test that the delta of a cleaning whose csv was not fed is kept by
+        the next cleaning
+        """
+        self.clean(chunksize=7)
+        commit_state("db_file.csv")
+
+        self.products[2]["last_modified_t"] += 100
+        self.products.append(off_product(21))
+        write_off_csv(self.fname, self.products)
+
+        self.clean(chunksize=7, incremental=True)
+        self.assertEqual(self.cleaned_codes(), [3, 21])
+
+        # the feeding failed: cleaned again against the same state
+        self.clean(chunksize=7, incremental=True)
+        self.assertEqual(self.cleaned_codes(), [3, 21])
+
+        commit_state("db_file.csv")
+        self.clean(chunksize=7, incremental=True)
+        self.assertEqual(self.cleaned_codes(), [])
+
+    def test_state_of_another_csv_not_saved(self):
+        """
+        Test that the pending state is not saved when the csv fed is not
+        the one of the cleaning
+        """
+        self.clean(chunksize=7)
+        with open("db_file.csv", "a") as f:
+            f.write("\n")
+
+        commit_state("db_file.csv")
+
+        self.assertFalse(os.path.exists("cleaner_state.json"))
+
+
+class NamesTestCase(SimpleTestCase):
+    """
+    Testing the brands and stores names of the products
+    """
+
+    def test_split_names(self):
+        """
+        Test that names are split, stripped and capitalized, indexed by
+        their row, empty ones being dropped
+        """
+        names = split_names(pd.Series(
+            ["lu, Carrefour ", np.nan, " ,BONNE maman", ""],
+            index=[10, 11, 12, 13],
+        ))
+
+        self.assertEqual(names.tolist(), ["Lu", "Carrefour", "Bonne maman"])
+        self.assertEqual(names.index.tolist(), [10, 10, 12])
+
+    def test_split_missing_names(self):
+        """
+        Test that a column without names gives no names
+        """
+        self.assertTrue(split_names(pd.Series([np.nan, np.nan])).empty)
+
+    def test_edges(self):
+        """
+        Test that the edges link the products to their names, in the order
+        of the rows, without duplicates
+        """
+        df = pd.DataFrame({
+            "url": ["u1", "u2", "u1", "u3"],
+            "brands": ["Lu, lu", "Carrefour,Lu", "Lu", np.nan],
+        })
+
+        edges = Dataset("db_file.csv", ["url", "brands"], df=df).edges(
+            "brands"
+        )
+
+        self.assertEqual(
+            list(zip(edges["url"], edges["name"])),
+            [("u1", "Lu"), ("u2", "Carrefour"), ("u2", "Lu")],
+        )
+        self.assertEqual(edges.index.tolist(), [0, 1, 2])
+
+
+class ReconcileCheckTestCase(CleanerTestCase):
+    """
+    Testing that only a csv holding the whole catalog is reconciled with
+    the database
+    """
+
+    def clean_delta(self):
+        """
+        Cleans the csv, then a modified product of it incrementally
+        """
+        self.clean(chunksize=7)
+        commit_state("db_file.csv")
+
+        self.products[2]["last_modified_t"] += 100
+        write_off_csv(self.fname, self.products)
+        self.clean(chunksize=7, incremental=True)
+
+    def reconcile(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            DBFeed("db_file.csv", HEADERS_LIST).reconcile()
+
+    def test_cleaning_records_delta(self):
+        """
+        Test that the cache records whether the csv only holds a delta, the
+        first incremental cleaning keeping the whole catalog
+        """
+        self.clean(chunksize=7, incremental=True)
+        self.assertIs(is_delta("db_file.csv"), False)
+
+        self.clean_delta()
+        self.assertIs(is_delta("db_file.csv"), True)
+
+    def test_reconcile_refuses_delta(self):
+        """
+        Test that a delta is not reconciled, before any query
+        """
+        self.clean_delta()
+
+        with self.assertRaisesRegex(ValueError, "delta"):
+            self.reconcile()
+
+    def test_reconcile_refuses_changed_csv(self):
+        """
+        Test that a csv changed since it was cleaned is not reconciled
+        """
+        self.clean(chunksize=7)
+        with open("db_file.csv", "a") as f:
+            f.write("\n")
+
+        self.assertIsNone(is_delta("db_file.csv"))
+        with self.assertRaisesRegex(ValueError, "clean it again"):
+            self.reconcile()
+
+
+class FeedStateTestCase(FeedTestCase):
+    """
+    Testing that the state of the cleaning is only saved by the feedings
+    leaving the products up to date
+    """
+
+    def test_fill_keeps_state(self):
+        """
+        Test that filling the products, which ignores the existing ones,
+        does not save the state of the cleaning
+        """
+        self.feed([off_product(1)])
+
+        self.assertEqual(self.urls(), [off_product(1)["url"]])
+        self.assertFalse(os.path.exists("cleaner_state.json"))
+
+    def test_delta_and_copy_save_state(self):
+        """
+        Test that a delta or a copy saves the state of the cleaning
+        """
+        for options in [{"copy": True}, {"delta": True}]:
+            with self.subTest(**options):
+                self.feed([off_product(1)], **options)
+
+                with open("cleaner_state.json") as f:
+                    state = json.load(f)
+                self.assertEqual(state["codes"], [1])
+                os.remove("cleaner_state.json")
+
+    def test_delta_needs_delta_option(self):
+        """
+        Test that the delta of an incremental cleaning is only fed with
+        delta, before anything is fed
+        """
+        self.feed([off_product(1)], incremental=True, delta=True)
+        product = off_product(2)
+
+        with self.assertRaisesRegex(ValueError, "--delta"):
+            self.feed([off_product(1), product], incremental=True)
+        self.assertEqual(self.urls(), [off_product(1)["url"]])
+
+        self.feed([off_product(1), product], incremental=True, delta=True)
+        self.assertEqual(self.urls(), [off_product(1)["url"], product["url"]])
+
+
+class CopyProductsTestCase(FeedTestCase):
+    """
+    Testing the products loaded with COPY
+    """
+
+    def test_copy_products(self):
+        """
+        Test that products get the ids of their first rows, with their
+        brands and stores links, and that the ids created next follow them
+        """
+        self.feed([
+            off_product(1, brands="Lu, Carrefour"),
+            off_product(2, main_category_fr="Soupes", stores="Auchan"),
+            off_product(1, product_name="Biscuit 1 bis"),
+        ], copy=True)
+
+        self.assertEqual(
+            dict(Product.objects.values_list("url", "id")),
+            {off_product(1)["url"]: 1, off_product(2)["url"]: 2},
+        )
+        self.assertEqual(Product.objects.get(id=1).name, "Biscuit 1")
+        self.assertEqual(self.names(1, "brands"), ["Carrefour", "Lu"])
+        self.assertEqual(self.names(1, "stores"), ["Carrefour"])
+        self.assertEqual(self.names(2, "brands"), ["Lu"])
+        self.assertEqual(self.names(2, "stores"), ["Auchan"])
+        self.assertEqual(Product.objects.get(id=2).cat.name, "Soupes")
+
+        product = Product.objects.create(
+            code=3, url=off_product(3)["url"], name="Biscuit 3",
+            cat=Category.objects.get(name="Biscuits"),
+            last_modified_t=Product.objects.get(id=1).last_modified_t,
+        )
+        self.assertEqual(product.id, 3)
+
+    def test_copy_needs_empty_table(self):
+        """
+        Test that products are not copied to a table which is not empty
+        """
+        self.feed([off_product(1)])
+
+        with self.assertRaisesRegex(RuntimeError, "empty table"):
+            self.feed([off_product(1), off_product(2)], copy=True)
+        self.assertEqual(self.urls(), [off_product(1)["url"]])
+
+
+class UpdateProductsTestCase(FeedTestCase):
+    """
+    Testing the products created or updated by a delta
+    """
+
+    def test_update_products(self):
+        """
+        Test that new products are created, and existing ones updated by
+        newer rows only, duplicated urls keeping their newest row
+        """
+        self.feed([off_product(code) for code in range(1, 4)])
+        t = off_product(1)["last_modified_t"]
+
+        self.feed([
+            off_product(
+                1, product_name="Soupe 1", main_category_fr="Soupes",
+                brands="Bonne maman", last_modified_t=t + 100,
+            ),
+            off_product(2, product_name="Biscuit 2 bis", last_modified_t=t),
+            off_product(
+                3, product_name="Biscuit 3 bis", last_modified_t=t + 100
+            ),
+            off_product(
+                3, product_name="Biscuit 3 ter", last_modified_t=t + 200
+            ),
+            off_product(4),
+        ], delta=True)
+
+        products = {
+            product.code: product for product in Product.objects.all()
+        }
+        self.assertEqual(sorted(products), [1, 2, 3, 4])
+        self.assertEqual(products[1].name, "Soupe 1")
+        self.assertEqual(products[1].cat.name, "Soupes")
+        self.assertEqual(self.names(1, "brands"), ["Bonne maman"])
+        self.assertEqual(products[2].name, "Biscuit 2")
+        self.assertEqual(products[3].name, "Biscuit 3 ter")
+        self.assertEqual(self.names(4, "stores"), ["Carrefour"])
+
+
+class RunBatchesTestCase(FeedTestCase):
+    """
+    Testing the checkpoints of the stages run by batches
+    """
+
+    def setUp(self):
+        super().setUp()
+        write_off_csv(self.fname, [off_product(1)])
+        self.clean()
+
+    def run_stage(self, fail_at=None):
+        """
+        Runs a stage creating the brands "0" to "6", two per batch, which
+        fails at the batch of fail_at. Returns the rows processed.
+        """
+        processed = []
+
+        def process(batch):
+            if fail_at in batch:
+                raise RuntimeError("stage failed")
+            Brand.objects.bulk_create(Brand(name=row) for row in batch)
+            processed.extend(batch)
+            return len(batch)
+
+        with self.quiet():
+            DBFeed("db_file.csv", HEADERS_LIST, batch_size=2).run_batches(
+                "brands", [str(row) for row in range(7)], process
+            )
+        return processed
+
+    def brands(self):
+        return sorted(Brand.objects.values_list("name", flat=True))
+
+    def test_resume_stage(self):
+        """
+        Test that a stage which failed resumes at the batch which failed,
+        its rows being written once
+        """
+        with self.assertRaisesRegex(RuntimeError, "stage failed"):
+            self.run_stage(fail_at="4")
+        self.assertEqual(self.brands(), ["0", "1", "2", "3"])
+
+        self.assertEqual(self.run_stage(), ["4", "5", "6"])
+        self.assertEqual(self.brands(), [str(row) for row in range(7)])
+
+    def test_new_file_resets_stage(self):
+        """
+        Test that the checkpoint of another version of the file is not
+        resumed
+        """
+        with self.assertRaisesRegex(RuntimeError, "stage failed"):
+            self.run_stage(fail_at="4")
+        Brand.objects.all().delete()
+
+        with open("db_file.csv", "a") as f:
+            f.write("\n")
+
+        self.assertEqual(self.run_stage(), [str(row) for row in range(7)])
+
+
+class ReconcileTestCase(FeedTestCase):
+    """
+    Testing the deletion of what left the catalog
+    """
+
+    def test_reconcile(self):
+        """
+        Test that the links, products and names which are not in the csv
+        anymore are deleted, favorites with their products
+        """
+        self.feed([
+            off_product(1, brands="Lu, Carrefour"),
+            off_product(2, stores="Auchan"),
+            off_product(3, brands="Bonne maman"),
+        ])
+        Favorite.objects.create(
+            substitute=Product.objects.get(code=3),
+            user=User.objects.create_user("user", password="password"),
+        )
+
+        self.feed([
+            off_product(1, brands="Lu"),
+            off_product(2, stores="Carrefour"),
+        ], reconcile=True)
+
+        self.assertEqual(
+            self.urls(), [off_product(1)["url"], off_product(2)["url"]]
+        )
+        self.assertFalse(Favorite.objects.exists())
+        self.assertEqual(self.names(1, "brands"), ["Lu"])
+        self.assertEqual(self.names(2, "stores"), ["Carrefour"])
+        self.assertEqual(
+            list(Brand.objects.values_list("name", flat=True)), ["Lu"]
+        )
+        self.assertEqual(
+            list(Store.objects.values_list("name", flat=True)), ["Carrefour"]
+        )
+
+
+class SubstitutesTestCase(FeedTestCase):
+    """
+    Testing the substitutes computed by the feeding
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.feed([
+            off_product(
+                code, product_name=name, nutrition_grade_fr=grade,
+                main_category_fr=category,
+            )
+            for code, name, grade, category in [
+                (1, "Biscuit chocolat", "c", "Biscuits"),
+                (2, "Biscuit chocolat noir", "a", "Biscuits"),
+                (3, "Biscuit nature", "b", "Biscuits"),
+                (4, "Biscuit chocolat", "a", "Biscuits"),
+                (5, "Biscuit chocolat", "e", "Biscuits"),
+                (6, "Soupe tomate", "b", "Soupes"),
+                (7, "Soupe poireaux", "a", "Soupes"),
+            ]
+        ])
+
+    def substitutes(self):
+        """
+        Returns the codes of the substitutes of each product, by rank
+        """
+        substitutes = {}
+        for code, substitute_code in Substitute.objects.order_by(
+            "product__code", "rank"
+        ).values_list("product__code", "substitute__code"):
+            substitutes.setdefault(code, []).append(substitute_code)
+        return substitutes
+
+    def test_substitutes(self):
+        """
+        Test that substitutes are the products of the same category, of a
+        better or equal grade and of another name, sharing words with the
+        product: best grades first, then most words shared
+        """
+        self.assertEqual(self.substitutes(), {
+            1: [2, 3],
+            2: [4],
+            3: [2, 4],
+            4: [2],
+            5: [2, 3],
+            6: [7],
+        })
+        self.assertEqual(
+            list(Substitute.objects.filter(
+                product__code=1
+            ).order_by("rank").values_list("rank", flat=True)),
+            [1, 2],
+        )
+
+    def test_substitutes_of_categories(self):
+        """
+        Test that only the substitutes of the categories passed are
+        computed again
+        """
+        Product.objects.filter(code__in=[3, 7]).update(nutri_grade="e")
+
+        with self.quiet():
+            DBFeed("db_file.csv", HEADERS_LIST).fill_substitutes(
+                [Category.objects.get(name="Biscuits").id]
+            )
+
+        self.assertEqual(self.substitutes(), {
+            1: [2],
+            2: [4],
+            3: [2, 4, 1, 5],
+            4: [2],
+            5: [2, 3],
+            # not computed again: 7 is not a better product anymore
+            6: [7],
+        })